@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Streaming application statistics over x'07' (app program terminated) records.
+AppStats takes record batches one by one and keeps per PSB and per transaction
+summaries - run count, failures by completion code, sum/mean/variance/min/max
+of extime, iotime, lktime, totio and dlicnt, quantile sketches and top-N runs.
+Records are not kept, so a month of logs needs memory of one batch only.
+Summaries of parallel workers or separate days are merged by merge(). Counts,
+sums, extremes, sketches and top-N merge exactly, variance is combined by
+Chan's parallel formula.
+
+Quantiles come from log-bucketed histograms (DDSketch-like) with relative
+error ACCURACY instead of t-digest - bucket counts just add up, so merged
+sketch is identical to the sketch of all records at once.
+
+    stats = appstats.AppStats()
+    for df in store.batches(types='07', columns=['blob', 'type', 'datetime']):
+        stats.update(df)
+    stats.summary('psb')
+    stats.top('extime')
+'''
+
+import pandas as pd
+import numpy as np
+import pickle
+import logspecs, imslog
+
+'''Accounting fields summarized for every PSB and transaction'''
+METRICS = ['extime', 'iotime', 'lktime', 'totio', 'dlicnt']
+
+'''Relative error of quantiles'''
+ACCURACY = 0.01
+
+'''Sketch bucket of zero values'''
+ZERO_BUCKET = np.iinfo(np.int64).min
+
+'''Fields of x'07' record used by the statistics'''
+FIELDS07 = logspecs.compile_fields({k: logspecs.log_items['07'][k]
+                                    for k in ['psb', 'tran', 'ccode', 'job'] + METRICS}, '07')
+
+'''Columns kept with top-N runs'''
+TOP_COLUMNS = ['datetime', 'psb', 'tran', 'job', 'ccode']
+
+
+def extract07(df):
+    '''x'07' records of df (records with blob and common fields) with accounting
+    fields as numbers and names with trailing blanks stripped'''
+    if 'extime' in df: return df     # fields extracted before
+    sel = np.flatnonzero(np.asarray(df['type'] == '07')) if 'type' in df else np.arange(len(df))
+    cols = FIELDS07.extract(df['blob'].iloc[sel].tolist())
+    res = pd.DataFrame(index=pd.RangeIndex(len(sel)))
+    if 'datetime' in df: res['datetime'] = np.asarray(df['datetime'])[sel]
+    for key in ['psb', 'tran', 'job']: res[key] = pd.Series(cols[key], dtype=object).str.rstrip().values
+    res['ccode'] = np.asarray(cols['ccode'], dtype=np.int64)
+    for key in METRICS: res[key] = np.asarray(cols[key]).astype(np.int64)
+    return res
+
+
+class AppStats:
+    '''Mergeable summaries of x'07' records by PSB and by transaction'''
+    def __init__(self, by=('psb', 'tran'), top_n=10, accuracy=ACCURACY):
+        self.by = list(by)
+        self.top_n = top_n
+        self.accuracy = accuracy
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self.moments = {k: None for k in self.by}    # key -> dataframe with count, failures and per metric sum, mean, m2, min, max
+        self.ccodes = {k: None for k in self.by}     # key -> count series indexed by (key value, ccode)
+        self.sketches = {k: None for k in self.by}   # key -> count series indexed by (key value, metric, bucket)
+        self.tops = {m: None for m in METRICS}       # metric -> top_n runs
+
+    def update(self, df):
+        '''Adds batch of records - x'07' records with blob (other types are skipped)
+        or dataframe with x'07' fields extracted already'''
+        df = extract07(df)
+        if len(df) == 0: return self
+        part = AppStats(self.by, self.top_n, self.accuracy)
+        for key in self.by:
+            part.moments[key] = batch_moments(df, key)
+            part.ccodes[key] = df[df['ccode'] != 0].groupby([key, 'ccode']).size()
+            part.sketches[key] = self.batch_sketch(df, key)
+        for m in METRICS:
+            cols = [c for c in TOP_COLUMNS if c in df] + [m]
+            part.tops[m] = df.nlargest(self.top_n, m, keep='first')[cols]
+        return self.merge(part)
+
+    def batch_sketch(self, df, key):
+        buckets = [pd.DataFrame({key: df[key].values, 'metric': m, 'bucket': self.bucket(df[m].values)})
+                   for m in METRICS]
+        return pd.concat(buckets, ignore_index=True).groupby([key, 'metric', 'bucket']).size()
+
+    def bucket(self, values):
+        '''Sketch bucket of every value, ceil(log_gamma(value))'''
+        values = np.asarray(values, dtype=np.float64)
+        res = np.full(len(values), ZERO_BUCKET, dtype=np.int64)
+        pos = values > 0
+        res[pos] = np.ceil(np.log(values[pos]) / np.log(self.gamma)).astype(np.int64)
+        return res
+
+    def value(self, buckets):
+        '''Representative value of sketch buckets'''
+        buckets = np.asarray(buckets, dtype=np.int64)
+        val = 2 * self.gamma ** buckets.astype(np.float64) / (self.gamma + 1)
+        return np.where(buckets == ZERO_BUCKET, 0.0, val)
+
+    def merge(self, other):
+        '''Adds summaries of other AppStats (the same by and accuracy) into this one, returns self'''
+        assert (self.by == other.by and self.gamma == other.gamma)
+        for key in self.by:
+            self.moments[key] = merge_moments(self.moments[key], other.moments[key])
+            self.ccodes[key] = add_counts(self.ccodes[key], other.ccodes[key])
+            self.sketches[key] = add_counts(self.sketches[key], other.sketches[key])
+        for m in METRICS:
+            if other.tops[m] is None: continue
+            both = other.tops[m] if self.tops[m] is None else pd.concat([self.tops[m], other.tops[m]])
+            self.tops[m] = both.nlargest(self.top_n, m, keep='first').reset_index(drop=True)
+        return self
+
+    def summary(self, key='psb', quantiles=(0.5, 0.9, 0.99)):
+        '''Dataframe indexed by key value - count, failures, failure rate and per metric
+        mean, std, min, max and quantiles (e.g. extime_p90)'''
+        mom = self.moments[key]
+        if mom is None: return pd.DataFrame()
+        res = pd.DataFrame({'count': mom['count'], 'failures': mom['failures'],
+                            'failure_rate': mom['failures'] / mom['count']})
+        for m in METRICS:
+            res[m+'_mean'] = mom[m+'_sum'] / mom['count']
+            res[m+'_std'] = np.sqrt(mom[m+'_m2'] / (mom['count'] - 1).where(mom['count'] > 1))
+            res[m+'_min'] = mom[m+'_min']
+            res[m+'_max'] = mom[m+'_max']
+            for q in quantiles:
+                res['{}_p{:g}'.format(m, q * 100)] = self.quantile(key, m, q)
+        return res.sort_values('count', ascending=False, kind='stable')
+
+    def quantile(self, key, metric, q):
+        '''Series key value -> approximate q quantile of metric'''
+        sk = self.sketches[key]
+        if sk is None: return pd.Series(dtype=np.float64)
+        sk = sk.xs(metric, level='metric').sort_index()
+        cum = sk.groupby(level=0).cumsum()
+        total = sk.groupby(level=0).transform('sum')
+        rank = np.floor(q * (total - 1))         # zero based rank of the quantile
+        hit = cum[cum > rank]
+        first = hit.groupby(level=0).head(1)
+        return pd.Series(self.value(first.index.get_level_values('bucket')),
+                         index=first.index.get_level_values(0), name='{}_p{:g}'.format(metric, q * 100))
+
+    def failures(self, key='psb'):
+        '''Failed runs by key value and completion code'''
+        if self.ccodes[key] is None: return pd.Series(dtype=np.int64)
+        return self.ccodes[key].rename('count')
+
+    def top(self, metric='extime'):
+        '''Top-N runs by metric'''
+        return self.tops[metric]
+
+    def save(self, path):
+        with open(path, 'wb') as f: pickle.dump(self, f)
+
+
+def file_stats(dsn):
+    '''Worker for imslog.load_log_files() - AppStats of one log file'''
+    return AppStats().update(imslog.load_log_file(dsn))
+
+
+def files_stats(files, workers=None):
+    '''AppStats of log files, computed in parallel file by file and merged'''
+    stats = AppStats()
+    for _, part in imslog.load_log_files(files, workers, file_stats): stats.merge(part)
+    return stats
+
+
+def load(path):
+    '''AppStats saved by AppStats.save()'''
+    with open(path, 'rb') as f: return pickle.load(f)
+
+
+def batch_moments(df, key):
+    '''Count, failures and per metric sum, mean, m2 (sum of squared deviations), min, max of one batch'''
+    g = df.groupby(key)
+    res = pd.DataFrame({'count': g.size(), 'failures': (df['ccode'] != 0).groupby(df[key]).sum()})
+    for m in METRICS:
+        res[m+'_sum'] = g[m].sum()
+        res[m+'_mean'] = g[m].mean()
+        res[m+'_m2'] = g[m].var(ddof=0) * res['count']
+        res[m+'_min'] = g[m].min()
+        res[m+'_max'] = g[m].max()
+    return res
+
+
+def merge_moments(a, b):
+    '''Combines two batch_moments() results, variance by Chan's parallel algorithm'''
+    if a is None: return b
+    if b is None: return a
+    idx = a.index.union(b.index)
+    a, b = a.reindex(idx), b.reindex(idx)
+    na, nb = a['count'].fillna(0), b['count'].fillna(0)
+    n = na + nb
+    res = pd.DataFrame({'count': n.astype(np.int64),
+                        'failures': (a['failures'].fillna(0) + b['failures'].fillna(0)).astype(np.int64)}, index=idx)
+    for m in METRICS:
+        ma, mb = a[m+'_mean'].fillna(0), b[m+'_mean'].fillna(0)
+        delta = mb - ma
+        res[m+'_sum'] = (a[m+'_sum'].fillna(0) + b[m+'_sum'].fillna(0)).astype(np.int64)
+        res[m+'_mean'] = ma + delta * nb / n
+        res[m+'_m2'] = a[m+'_m2'].fillna(0) + b[m+'_m2'].fillna(0) + delta ** 2 * na * nb / n
+        res[m+'_min'] = np.fmin(a[m+'_min'], b[m+'_min']).astype(np.int64)
+        res[m+'_max'] = np.fmax(a[m+'_max'], b[m+'_max']).astype(np.int64)
+    return res
+
+
+def add_counts(a, b):
+    '''Sum of two count series with (partly) different index'''
+    if a is None: return b
+    if b is None: return a
+    return a.add(b, fill_value=0).astype(np.int64)
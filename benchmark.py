@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Benchmark of the processing stages on synthetic log file (see loggen.py).
+Every stage reports records/s, MB/s and peak RSS of the process while it runs:
+    download       LogDownloader.write fed by FTP sized blocks, output is checked
+                   against the log (fails the run when it differs)
+    split          IMSLogDataset.get_records, list of bytes
+    split_mmap     IMSLogDataset.get_records, mapped file
+    common         logspecs.extract_common_fields
+    fields_<spec>  logspecs.extract_typespecific_fields for 07, 42, 50, 67ff and deadlock_map
+    hdf_write      HDF write of dataframe with common fields
+    hdf_read       HDF read of it
+
+    python benchmark.py --size 100 --save bench.json
+    python benchmark.py --size 100 --baseline bench.json
+
+With --baseline the run fails (exit code 1) when any stage is slower
+than the baseline by more than --tolerance.
+'''
+
+import pandas as pd
+import sys, os, io, re, time, json, argparse, threading, tempfile, warnings, psutil
+import logspecs, loggen
+from logdownloader import LogDownloader, DELIMETER
+from imslog import IMSLogDataset
+
+'''FTP block size used by ftplib.retrbinary'''
+BLOCK_SIZE = 8192
+
+'''Block sizes download output is checked with besides BLOCK_SIZE - records end at every block boundary offset'''
+CHECK_BLOCK_SIZES = (1, 2, 3, 5)
+
+'''Records of the log the small block sizes are checked on'''
+CHECK_RECORDS = 2000
+
+'''Interval of RSS sampling during a stage'''
+RSS_INTERVAL = 0.005
+
+
+class PeakRSS:
+    '''Context manager sampling RSS of this process in background thread, peak is in self.peak'''
+    def __init__(self, interval=RSS_INTERVAL):
+        self.process = psutil.Process()
+        self.interval = interval
+        self.peak = 0
+        self.running = False
+
+    def sample(self):
+        self.peak = max(self.peak, self.process.memory_info().rss)
+
+    def watch(self):
+        while self.running:
+            self.sample()
+            time.sleep(self.interval)
+
+    def __enter__(self):
+        self.running = True
+        self.sample()
+        self.thread = threading.Thread(target=self.watch, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.running = False
+        self.thread.join()
+        self.sample()
+
+
+def measure(name, func, records, nbytes, results):
+    '''Runs func once, appends stage statistics to results and returns func result'''
+    with PeakRSS() as rss:
+        start = time.perf_counter()
+        res = func()
+        seconds = time.perf_counter() - start
+    stats = {'stage': name, 'records': records, 'bytes': nbytes, 'seconds': seconds,
+             'records_s': records / seconds if seconds > 0 else 0.0,
+             'mb_s': nbytes / seconds / 1e6 if seconds > 0 else 0.0,
+             'peak_rss_mb': rss.peak / 1e6}
+    results.append(stats)
+    print('{stage:16} {records:10d} {seconds:9.3f} {records_s:12.0f} {mb_s:9.1f} {peak_rss_mb:10.1f}'.format(**stats))
+    sys.stdout.flush()
+    return res
+
+
+def text_mode_lrecs(records):
+    '''Record lengths as text mode download would report them - fake 0D15/0D25 pairs split records'''
+    lrecs = []
+    for rec in records:
+        lrecs.extend(len(part) for part in re.split(b'\x0d[\x15\x25]', rec))
+    return lrecs
+
+
+def download(stream, lrecs, block_size=BLOCK_SIZE):
+    out = io.BytesIO()
+    ld = LogDownloader(out, lrecs)
+    for i in range(0, len(stream), block_size):
+        ld.write(stream[i:i + block_size])
+    ld.finish()
+    return out
+
+
+def check_download(recs, out):
+    '''Download output must be the delimited log - out is output of the measured
+    download, first CHECK_RECORDS records are downloaded again in small blocks'''
+    if out.getvalue() != DELIMETER.join(recs):
+        raise ValueError('download output differs from the log, block size {}'.format(BLOCK_SIZE))
+    recs = recs[:CHECK_RECORDS]
+    lrecs = text_mode_lrecs(recs)
+    for block_size in CHECK_BLOCK_SIZES:       # LogDownloader prolongs lengths in place, copy them
+        if download(b''.join(recs), list(lrecs), block_size).getvalue() != DELIMETER.join(recs):
+            raise ValueError('download output differs from the log, block size {}'.format(block_size))
+
+
+def run(size_mb=50, seed=0, workdir=None):
+    '''Generates synthetic log of size_mb megabytes and measures all stages on it.
+    Returns list of stage statistics.'''
+    tmp = tempfile.TemporaryDirectory(dir=workdir)
+    dsn = os.path.join(tmp.name, 'SYNTH.LOG')
+    hdf = os.path.join(tmp.name, 'synth.h5')
+    print('Generating {} MB synthetic log'.format(size_mb))
+    count = len(loggen.generate(dsn, size_mb=size_mb, seed=seed))
+    size = os.path.getsize(dsn)
+    results = []
+    print('{:16} {:>10} {:>9} {:>12} {:>9} {:>10}'.format('stage', 'records', 'seconds', 'records/s', 'MB/s', 'peak RSS'))
+
+    recs = measure('split', lambda: IMSLogDataset(dsn).get_records(), count, size, results)
+
+    stream = b''.join(recs)             # what FTP binary transfer delivers
+    lrecs = text_mode_lrecs(recs)
+    out = measure('download', lambda: download(stream, lrecs), count, len(stream), results)
+    check_download(recs, out)
+    stream = lrecs = out = None
+
+    def split_mmap():
+        tlog = IMSLogDataset(dsn, use_mmap=True)
+        n = len(tlog.get_records())
+        tlog.close()
+        return n
+    measure('split_mmap', split_mmap, count, size, results)
+
+    df = pd.DataFrame({'blob': recs})
+    recs = None
+    measure('common', lambda: logspecs.extract_common_fields(df), count, size, results)
+
+    specs = [('07', df['type'] == '07', logspecs.log_items['07']),
+             ('42', df['type'] == '42', logspecs.log_items['42']),
+             ('50', df['type'] == '50', logspecs.log_items['50']),
+             ('67ff', (df['type'] == '67') & (df['subtype'] == 'ff'), logspecs.log_items['67']['ff'])]
+    for name, mask, spec in specs:
+        sub = df[mask].copy()
+        measure('fields_'+name, lambda: logspecs.extract_typespecific_fields(spec, sub), len(sub),
+                int(sub['blob'].map(len).sum()), results)
+        if name == '67ff':
+            sub = sub[sub['name'] == 'DEADLOCK'].copy()
+            measure('fields_deadlock', lambda: logspecs.extract_typespecific_fields(logspecs.deadlock_map, sub),
+                    len(sub), int(sub['blob'].map(len).sum()), results)
+
+    def hdf_write():
+        store = pd.HDFStore(hdf, mode='w')
+        warnings.simplefilter('ignore', pd.errors.PerformanceWarning)   # blob column is pickled, as in imslog
+        store['df'] = df.astype({'type': object, 'subtype': object})
+        store.close()
+    measure('hdf_write', hdf_write, count, size, results)
+    df = None
+
+    def hdf_read():
+        store = pd.HDFStore(hdf, mode='r')
+        res = store['df']
+        store.close()
+        return res
+    measure('hdf_read', hdf_read, count, os.path.getsize(hdf), results)
+    tmp.cleanup()
+    return results
+
+
+def regressions(results, baseline, tolerance):
+    '''Stages slower than in baseline by more than tolerance (0.2 = 20 %)'''
+    base = {r['stage']: r for r in baseline}
+    slow = []
+    for r in results:
+        b = base.get(r['stage'])
+        if b is None or b['mb_s'] == 0: continue
+        if r['mb_s'] < b['mb_s'] * (1 - tolerance):
+            slow.append((r['stage'], b['mb_s'], r['mb_s']))
+    return slow
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks log processing stages on synthetic log file.')
+    parser.add_argument('--size', type=float, default=50, help='size of synthetic log in MB')
+    parser.add_argument('--seed', type=int, default=0, help='random seed of the log generator')
+    parser.add_argument('--workdir', default=None, help='directory for temporary files')
+    parser.add_argument('--save', default=None, help='save results into this JSON file')
+    parser.add_argument('--baseline', default=None, help='compare with results saved by --save')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown against baseline')
+    args = parser.parse_args(argv)
+    results = run(args.size, args.seed, args.workdir)
+    if args.save is not None:
+        with open(args.save, 'w') as f: json.dump(results, f, indent=1)
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as f: baseline = json.load(f)
+        slow = regressions(results, baseline, args.tolerance)
+        for stage, was, now in slow:
+            print('REGRESSION {}: {:.1f} MB/s -> {:.1f} MB/s'.format(stage, was, now))
+        if slow: return 1
+        print('No regression against {}'.format(args.baseline))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Deadlock analysis over x'67' ff DEADLOCK records. Waiter and blocker fields
+of all DEADLOCK records are extracted in one vectorized pass, then they are
+aggregated into wait-for graph (waiter -> blocker edges weighted by number of
+occurrences per DMB and time window), the most conflicting pairs and the
+deadlock cycles which keep coming back.
+
+    dl = deadlock.extract_deadlocks(df)            # df with common fields
+    dl = deadlock.load_deadlocks(LogStore('store/'), start='2018-08-01')
+    deadlock.top_pairs(dl)
+    deadlock.recurring_cycles(dl)
+'''
+
+import pandas as pd
+import numpy as np
+import logspecs
+
+'''Fields of DEADLOCK record - x'67' ff header plus deadlock_map, gathered at once'''
+DEADLOCK_FIELDS = logspecs.compile_fields(dict(logspecs.log_items['67']['ff'], **logspecs.deadlock_map), '67ff')
+
+'''x'67' ff records written for one deadlock are not further apart than this'''
+EVENT_GAP = pd.Timedelta('1s')
+
+
+def extract_deadlocks(df):
+    '''Dataframe of DEADLOCK records found in df (records with blob and common fields).
+    Columns are datetime, sequence and deadlock_map fields with trailing blanks stripped.'''
+    sel = np.flatnonzero(np.asarray((df['type'] == '67') & (df['subtype'] == 'ff')))
+    cols = DEADLOCK_FIELDS.extract(df['blob'].iloc[sel].tolist())
+    keep = np.array([n == 'DEADLOCK' for n in cols['name']], dtype=bool)
+    dl = pd.DataFrame({'datetime': np.asarray(df['datetime'])[sel][keep]})
+    if 'sequence' in df: dl['sequence'] = np.asarray(df['sequence'])[sel][keep]
+    for key, it in logspecs.deadlock_map.items():
+        val = np.asarray(cols[key], dtype=object)[keep]
+        dl[key] = pd.Series(val, dtype=object).str.rstrip().values if it['type'] == 'txt' else val.astype(np.int64)
+    return dl.sort_values('datetime', kind='stable').reset_index(drop=True)
+
+
+def load_deadlocks(store, start=None, end=None):
+    '''DEADLOCK records of given time range from LogStore, only x'67' ff partitions are read'''
+    df = store.read(types='67', subtypes='ff', start=start, end=end,
+                    columns=['blob', 'sequence', 'datetime', 'type', 'subtype'])
+    return extract_deadlocks(df)
+
+
+def wait_for_graph(dl, key='psb', freq='1D', by_dmb=True):
+    '''Aggregated wait-for graph - one row per waiter -> blocker edge (key is psb,
+    tran, imsid or pcb) in time window of freq and DMB, weighted by count.'''
+    groups = [dl['datetime'].dt.floor(freq).rename('window')]
+    if by_dmb: groups.append(dl['dmb'])
+    groups += [dl['waiter_'+key].rename('waiter'), dl['blockr_'+key].rename('blocker')]
+    graph = dl.groupby(groups, observed=True, sort=True).size().rename('count').reset_index()
+    return graph.sort_values(['window', 'count'], ascending=[True, False], kind='stable').reset_index(drop=True)
+
+
+def top_pairs(dl, key='psb', n=10):
+    '''Most frequently conflicting pairs regardless of who waited for whom,
+    with the DMBs they collided in and the first and last occurrence.'''
+    w, b = dl['waiter_'+key].values, dl['blockr_'+key].values
+    swap = w > b
+    pairs = pd.DataFrame({'a': np.where(swap, b, w), 'b': np.where(swap, w, b),
+                          'dmb': dl['dmb'].values, 'datetime': dl['datetime'].values})
+    res = pairs.groupby(['a', 'b'], sort=False).agg(count=('dmb', 'size'),
+                                                   dmbs=('dmb', lambda d: ','.join(sorted(set(d)))),
+                                                   first=('datetime', 'min'), last=('datetime', 'max'))
+    return res.sort_values('count', ascending=False, kind='stable').head(n).reset_index()
+
+
+def participants(dl, side):
+    '''Identity of waiter or blocker (side 'waiter' or 'blockr') - IMS id and PST
+    number, PSB or transaction names are shared by many regions'''
+    return dl[side+'_imsid'].astype(str) + ':' + dl[side+'_pst'].astype(str)
+
+
+def deadlock_events(dl, gap=EVENT_GAP):
+    '''Event number of every record. Record joins an open event (its first record is
+    not more than gap older) when it continues the event's wait-for chain - its
+    waiter is blocker there or its blocker is waiter there - and nobody would wait
+    or be waited for twice. Closed cycle takes no more records. Otherwise the
+    record starts its own event, so unrelated deadlocks close in time are never merged.'''
+    t = dl['datetime'].values
+    gap = np.timedelta64(gap)
+    waiters, blockers = participants(dl, 'waiter').tolist(), participants(dl, 'blockr').tolist()
+    events = np.empty(len(dl), dtype=np.int64)
+    opened = []        # [first datetime, event number, waiters, blockers]
+    for i, (w, b) in enumerate(zip(waiters, blockers)):
+        opened = [ev for ev in opened if t[i] - ev[0] <= gap and ev[2] != ev[3]]
+        for ev in opened:
+            if (w in ev[3] or b in ev[2]) and w not in ev[2] and b not in ev[3]: break
+        else:
+            ev = [t[i], i, set(), set()]
+            opened.append(ev)
+        ev[2].add(w)
+        ev[3].add(b)
+        events[i] = ev[1]
+    return events
+
+
+def event_cycle(waiters, blockers, labels=None):
+    '''Cycle of one deadlock from its waiter -> blocker edges (every waiter once),
+    with nodes renamed by labels dict and rotated so it starts with the smallest
+    one. Edge without continuation closes the cycle - IMS writes the record for
+    the victim only, its blocker waits for the victim.'''
+    nxt = dict(zip(waiters, blockers))
+    heads = set(waiters) - set(blockers)      # chain start when the cycle is not closed by records
+    node, path = min(heads) if heads else min(waiters), []
+    while node not in path:
+        path.append(node)
+        if node not in nxt: break
+        node = nxt[node]
+    else:
+        path = path[path.index(node):]
+    if labels is not None: path = [labels[n] for n in path]
+    i = path.index(min(path))
+    return tuple(path[i:] + path[:i])
+
+
+def recurring_cycles(dl, key='psb', gap=EVENT_GAP, min_count=2):
+    '''Deadlock cycles (tuples of key values) which occurred at least min_count times'''
+    if len(dl) == 0: return pd.DataFrame(columns=['cycle', 'count', 'dmbs', 'first', 'last'])
+    ev = pd.DataFrame({'event': deadlock_events(dl, gap),
+                       'wid': participants(dl, 'waiter').values, 'bid': participants(dl, 'blockr').values,
+                       'w': dl['waiter_'+key].values, 'b': dl['blockr_'+key].values,
+                       'dmb': dl['dmb'].values, 'datetime': dl['datetime'].values})
+    rows = []
+    for _, g in ev.groupby('event', sort=True):
+        labels = dict(zip(g['bid'], g['b']))
+        labels.update(zip(g['wid'], g['w']))
+        rows.append((event_cycle(g['wid'].tolist(), g['bid'].tolist(), labels),
+                     ','.join(sorted(set(g['dmb']))), g['datetime'].iloc[0]))
+    ev = pd.DataFrame(rows, columns=['cycle', 'dmbs', 'datetime'])
+    res = ev.groupby('cycle', sort=False).agg(count=('dmbs', 'size'),
+                                             dmbs=('dmbs', lambda d: ','.join(sorted(set(','.join(d).split(','))))),
+                                             first=('datetime', 'min'), last=('datetime', 'max'))
+    res = res[res['count'] >= min_count]
+    return res.sort_values('count', ascending=False, kind='stable').reset_index()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Check of ftpdown.py RDW_MODE against local FTP stand-in. Synthetic log (see
+loggen.py) is served by pyftpdlib like z/OS serves a variable length dataset -
+quoted dataset names, and with SITE RDW every record prefixed by its record
+descriptor word. ftpdown.fetch() downloads it through FTPPool and the result
+must be byte identical to the generated log; the same download streamed into
+LogStore must hold all its records. Text mode pass needs modified
+ftp.retrlines() (see ftpdown.transfer()), so it is not checked here.
+
+    python ftpcheck.py --size 5
+
+Exit code is 1 when any check fails.
+'''
+
+from pyftpdlib.authorizers import DummyAuthorizer
+from pyftpdlib.handlers import FTPHandler
+from pyftpdlib.servers import FTPServer
+from pyftpdlib.log import config_logging
+import sys, os, argparse, tempfile, threading, logging
+import ftpdown, loggen
+from imslog import IMSLogDataset
+from logstore import LogStore
+
+USER = 'ims'
+PASS = 'ims'
+
+'''Served copy of dataset with record descriptor words, sent after SITE RDW'''
+RDW_SUFFIX = '.rdw'
+
+
+def rdw_copy(dsn, dest):
+    '''Writes records of delimited log file dsn into dest, each prefixed by RDW'''
+    with open(dest, 'wb') as f:
+        for rec in IMSLogDataset(dsn).get_records():
+            f.write((len(rec) + 4).to_bytes(2, 'big') + b'\x00\x00' + rec)
+
+
+class MVSHandler(FTPHandler):
+    '''FTP handler answering like z/OS FTP server - dataset names come in quotes,
+    SITE RDW switches the session to RDW copies of the datasets'''
+    proto_cmds = dict(FTPHandler.proto_cmds, **{'SITE RDW': dict(
+        perm=None, auth=True, arg=False, help='Syntax: SITE RDW (keep record descriptor words).')})
+    rdw = False
+
+    def ftp_SITE_RDW(self, arg):
+        self.rdw = True
+        self.respond('200 SITE command was accepted')
+
+    def pre_process_command(self, line, cmd, arg):
+        if cmd == 'RETR' and arg:
+            arg = arg.strip('\'') + (RDW_SUFFIX if self.rdw else '')
+        return FTPHandler.pre_process_command(self, line, cmd, arg)
+
+
+def serve(root):
+    '''Starts FTP stand-in serving root directory in background thread, returns the server'''
+    authorizer = DummyAuthorizer()
+    authorizer.add_user(USER, PASS, root, perm='elr')
+    handler = type('Handler', (MVSHandler,), {'authorizer': authorizer})
+    server = FTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, kwargs={'timeout': 0.1}, daemon=True).start()
+    return server
+
+
+def run(size_mb=5, seed=0, workdir=None):
+    '''Generates log of size_mb megabytes, serves it and downloads it by ftpdown.
+    Returns list of failed checks, empty when all is well.'''
+    tmp = tempfile.TemporaryDirectory(dir=workdir)
+    root, dest = os.path.join(tmp.name, 'host'), os.path.join(tmp.name, 'slds', '')
+    os.makedirs(root)
+    os.makedirs(dest)
+    fn = 'IMS.SLDSP.SYNTH'
+    dsn = os.path.join(root, fn)
+    records = loggen.generate(dsn, size_mb=size_mb, seed=seed)
+    rdw_copy(dsn, dsn + RDW_SUFFIX)
+    config_logging(level=logging.WARNING)
+    server = serve(root)
+    pool = ftpdown.FTPPool(1, '127.0.0.1', USER, PASS, server.address[1], rdw=True, timeout=30)
+    bin_dest, ftpdown.BIN_DEST = ftpdown.BIN_DEST, dest
+    failed = []
+    try:
+        stats = ftpdown.fetch(pool, fn, retries=0)
+        with open(dsn, 'rb') as f: expected = f.read()
+        if stats['error']: failed.append('fetch: ' + stats['error'])
+        elif stats['flushed']: failed.append('fetch: {} bytes flushed'.format(stats['flushed']))
+        else:
+            with open(dest + fn, 'rb') as f:
+                if f.read() != expected: failed.append('fetch: downloaded file differs from the log')
+        store = LogStore(os.path.join(tmp.name, 'store'))
+        stats = ftpdown.fetch(pool, fn, retries=0, store=store)
+        if stats['error']: failed.append('stream: ' + stats['error'])
+        elif sorted(store.read(columns=['blob'])['blob']) != sorted(IMSLogDataset(dsn).get_records()):
+            failed.append('stream: stored records differ from the log')
+        print('{} records, {} bytes served with RDWs'.format(len(records), os.path.getsize(dsn + RDW_SUFFIX)))
+    finally:
+        ftpdown.BIN_DEST = bin_dest
+        pool.close()
+        server.close_all()
+        tmp.cleanup()
+    return failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Checks RDW mode of ftpdown.py against local FTP stand-in.')
+    parser.add_argument('--size', type=float, default=5, help='size of synthetic log in MB')
+    parser.add_argument('--seed', type=int, default=0, help='random seed of the log generator')
+    parser.add_argument('--workdir', default=None, help='directory for temporary files')
+    args = parser.parse_args(argv)
+    failed = run(args.size, args.seed, args.workdir)
+    for msg in failed: print('FAILED ' + msg)
+    if failed: return 1
+    print('RDW download is byte identical to the log')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
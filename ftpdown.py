@@ -12,6 +12,18 @@ each record with new line delimeter. From such file can be extracted array of re
 lengths. After that binary download follows, resulting file is stored in file system
 with LogDownloader class. Resulting files are in binary format where each record is 
 delimited by custom delimeter defined in LogDownloader.py.
+With RDW_MODE (off by default until tried against real host) each file is
+downloaded only once: SITE RDW keeps record descriptor words in the binary
+transfer and RDWDownloader turns them into delimeters, so neither the text
+pass nor the patched ftp.retrlines() is needed. ftpcheck.py checks this mode
+against local FTP stand-in.
+Datasets are fetched in parallel over a pool of WORKERS FTP sessions. Failed
+transfers are retried with backoff, each file is written to .part file renamed
+on success, and throughput of every dataset is reported at the end.
+With STREAM_STORE the downloaded bytes are parsed on the fly and appended
+to LogStore in batches (see logstream.py), raw copy in BIN_DEST is written only
+with KEEP_RAW. With METRICS_REPORT per dataset transfer times, bytes and records
+are written into JSON (or .csv) file at the end (see metrics.py).
 
 Execute with  python -O ftpdown.py
 '''
@@ -21,11 +33,23 @@ USER = 'login'
 PASS = 'password'
 DOWNLOAD_LIST = 'conf/download_list.txt'
 BIN_DEST = 'slds/'
+PORT = 21
+RDW_MODE = False     # SITE RDW single pass download, not tried against real host yet
+WORKERS = 4          # concurrent FTP sessions
+RETRIES = 3          # retries of a failed transfer
+BACKOFF = 5.0        # seconds before first retry, doubled with every next one
+TIMEOUT = 300.0      # seconds a stalled connection or transfer waits before it fails and is retried
+STREAM_STORE = None  # LogStore directory for streaming mode, None downloads files only
+KEEP_RAW = False     # streaming mode also writes raw log files to BIN_DEST
+METRICS_REPORT = None  # file for stage metrics of the run, None writes none
 
 
-from logdownloader import LogDownloader
+from logdownloader import LogDownloader, RDWDownloader
+from logstore import LogStore
+import logstream, metrics
+from concurrent.futures import ThreadPoolExecutor
 import ftplib
-import os, sys
+import os, sys, time, threading, contextlib
 
 
 def storbin(block,fo):
@@ -34,63 +58,210 @@ def storbin(block,fo):
 def stortxt_obsolete(block,fo):
     bb = (block+'aa').encode('latin-1')
     fo.write(bb)
-        
-def download_bin(fn, lrecs):
-    '''FTP download of a binary file'''
-    quoted_fn = '\''+fn+'\''
-    print('Downloading bin '+quoted_fn, end='')
-    sys.stdout.flush()
-    error = False
-    with open(BIN_DEST+fn, 'wb') as fob:
-        try: 
-            ld = LogDownloader(fob, lrecs)
-            ftp.retrbinary('RETR '+quoted_fn, lambda block: ld.write(block))
-            ld.done()
-            print(' done.', end='\n')
-        except ftplib.error_perm as e:
-            error = True
-            print(' Error: '+str(e), end='\n')
-    sys.stdout.flush()
-    if error: os.remove(BIN_DEST+fn)
-
-def retrieve_record_lens(fn):
-    '''FTP download of a text file
-    It needs to run modified ftp.retrlines() to work correctly.
-    This modification lives in C:\Program Files\Python35\Lib, it supports newline parameter,
-    which is needed because standard implementation works with \n but it can be 
-    misplaced easily. Passing \r\n fixes the problem.
-    This functions returns a list of dataset record lengths.
-    '''
+
+
+class FTPPool:
+    '''Bounded pool of logged in FTP sessions shared by download threads'''
+
+    def __init__(self, size, site=SITE, user=USER, password=PASS, port=PORT, rdw=RDW_MODE, timeout=TIMEOUT):
+        self.size = size
+        self.site, self.user, self.password, self.port = site, user, password, port
+        self.rdw = rdw
+        self.timeout = timeout
+        self.idle = []
+        self.created = 0
+        self.cond = threading.Condition()    # signalled when session is released or pool can grow again
+
+    def connect(self):
+        ftp = ftplib.FTP(timeout=self.timeout)     # socket timeout, a stalled transfer raises and is retried
+        ftp.connect(self.site, self.port)
+        ftp.login(self.user, self.password)
+        if self.rdw: ftp.sendcmd('SITE RDW')
+        return ftp
+
+    def acquire(self):
+        '''Idle session, new one while pool is not full, otherwise wait until
+        a session is released or a broken one leaves room for new one'''
+        with self.cond:
+            while not self.idle and self.created >= self.size:
+                self.cond.wait()
+            if self.idle: return self.idle.pop()
+            self.created += 1
+        try:
+            return self.connect()
+        except Exception:
+            self.discard()
+            raise
+
+    def discard(self):
+        with self.cond:
+            self.created -= 1
+            self.cond.notify()
+
+    def release(self, ftp, broken=False):
+        '''Return session to pool, broken one is closed and replaced on demand'''
+        if not broken:
+            with self.cond:
+                self.idle.append(ftp)
+                self.cond.notify()
+            return
+        try:
+            ftp.close()
+        finally:
+            self.discard()
+
+    def close(self):
+        with self.cond:
+            sessions, self.idle = self.idle, []
+            self.created -= len(sessions)
+        for ftp in sessions:
+            try:
+                ftp.quit()
+            except ftplib.all_errors:
+                ftp.close()
+
+
+def transfer(ftp, fn, fob, rdw=RDW_MODE):
+    '''Download fn into fob, returns bytes received and bytes flushed by downloader.
+    Without rdw record lengths come from text mode pass, which needs modified
+    ftp.retrlines() with newline parameter (standard one splits on \n, which can
+    be misplaced easily, \r\n fixes the problem).'''
     quoted_fn = '\''+fn+'\''
-    print('Downloading txt '+quoted_fn, end='')
-    sys.stdout.flush()
-    lrecs = []
-    try: 
-        ftp.retrlines('RETR '+quoted_fn, lambda block: lrecs.append(len(block)), newline='\r\n')
-        print(' done - record lengths retrieved, record count = {}, max record = {}.'.format(len(lrecs), max(lrecs)), end='\n')
-    except ftplib.error_perm as e:
-        print(' Error: '+str(e), end='\n')
-    sys.stdout.flush()
+    received = 0
+    def counted(write):
+        def callback(block):
+            nonlocal received
+            received += len(block)
+            write(block)
+        return callback
+    if rdw:
+        ld = RDWDownloader(fob)
+        with metrics.stage('download', 'rdw') as st:
+            ftp.retrbinary('RETR '+quoted_fn, counted(ld.write))
+            ld.finish()
+            st.bytes, st.records = received, ld.record_count
+    else:
+        lrecs = []
+        with metrics.stage('record_lengths') as st:
+            ftp.retrlines('RETR '+quoted_fn, lambda block: lrecs.append(len(block)), newline='\r\n')
+            st.records = len(lrecs)
+        if (len(lrecs) == 0): raise ftplib.error_perm('550 No records in '+fn)
+        ld = LogDownloader(fob, lrecs)
+        with metrics.stage('download', 'bin') as st:
+            ftp.retrbinary('RETR '+quoted_fn, counted(ld.write))
+            ld.finish()
+            st.bytes, st.records = received, len(lrecs)
+    if ld.bytes_flushed: metrics.count('flushed', fn, nbytes=ld.bytes_flushed)
+    return received, ld.bytes_flushed
 
-    return lrecs
+def transfer_stream(ftp, fn, store, raw=None, rdw=RDW_MODE):
+    '''Download fn straight into the store. Download runs in its own thread,
+    parsing and storing of record batches in this one. raw is optional path
+    of raw copy of the log. Returns the same as transfer().'''
+    with open(raw, 'wb') if raw else contextlib.nullcontext() as fob:
+        sink = logstream.ChunkQueue(fob)
+        result = {}
+        def download():
+            try:
+                result['transfer'] = transfer(ftp, fn, sink, rdw)
+            except BaseException as e:
+                sink.close(e)
+            else:
+                sink.close()
+        downloader = threading.Thread(target=download, name='download '+fn)
+        downloader.start()
+        try:
+            logstream.ingest_stream(sink, store, fn)
+        except:
+            sink.abandon()
+            raise
+        finally:
+            downloader.join()
+    return result['transfer']
 
+def fetch(pool, fn, retries=RETRIES, backoff=BACKOFF, store=None, keep_raw=KEEP_RAW):
+    '''Download one dataset through the pool with retries.
+    Output goes to .part file which is renamed to BIN_DEST+fn on success.
+    With store the dataset is streamed into it, .part file is written only with keep_raw.
+    Permanent errors (e.g. dataset not found) are not retried.
+    Returns dict with dataset statistics.'''
+    dest = BIN_DEST+fn
+    tmp = dest+'.part'
+    stats = {'dsn': fn, 'bytes': 0, 'flushed': 0, 'seconds': 0.0, 'attempts': 0, 'error': None}
+    for attempt in range(retries+1):
+        stats['attempts'] = attempt + 1
+        ftp = None
+        start = time.perf_counter()
+        try:
+            ftp = pool.acquire()
+            if store is None:
+                with open(tmp, 'wb') as fob:
+                    stats['bytes'], stats['flushed'] = transfer(ftp, fn, fob, pool.rdw)
+            else:
+                stats['bytes'], stats['flushed'] = transfer_stream(ftp, fn, store, tmp if keep_raw else None, pool.rdw)
+            stats['seconds'] = time.perf_counter() - start
+            metrics.count('fetch', fn, nbytes=stats['bytes'], wall=stats['seconds'], calls=1)
+            pool.release(ftp)
+            if os.path.exists(tmp): os.replace(tmp, dest)
+            stats['error'] = None
+            break
+        except ftplib.all_errors as e:
+            permanent = isinstance(e, ftplib.error_perm)
+            if ftp is not None: pool.release(ftp, broken=not permanent)
+            if os.path.exists(tmp): os.remove(tmp)
+            stats['error'] = str(e).strip()
+            metrics.count('failed_attempts', fn, wall=time.perf_counter() - start, calls=1)
+            print('{}: attempt {} failed: {}'.format(fn, attempt + 1, stats['error']))
+            sys.stdout.flush()
+            if permanent: break
+            if (attempt < retries): time.sleep(backoff * 2**attempt)
+    return stats
 
-with open(DOWNLOAD_LIST, 'r') as f:
-    try:
-        ftp = ftplib.FTP(SITE)
-        ftp.login(USER, PASS)
-        print('FTP connected: {}'.format(ftp.getwelcome()))
-        print('FTP encoding: {}'.format(ftp.encoding))
+def report(results):
+    '''Per-dataset throughput table'''
+    total_bytes = 0
+    print('{:44} {:>12} {:>9} {:>9} {:>4}  {}'.format('dataset', 'bytes', 'seconds', 'MB/s', 'try', 'status'))
+    for r in results:
+        mbs = r['bytes'] / r['seconds'] / 1e6 if r['seconds'] > 0 else 0.0
+        status = 'error: '+r['error'] if r['error'] else 'ok' if r['flushed'] == 0 else 'flushed {}'.format(r['flushed'])
+        print('{:44} {:12d} {:9.1f} {:9.2f} {:4d}  {}'.format(r['dsn'], r['bytes'], r['seconds'], mbs, r['attempts'], status))
+        if not r['error']: total_bytes += r['bytes']
+    return total_bytes
+
+def download_all(files, pool, workers=WORKERS, retries=RETRIES, backoff=BACKOFF, store=None, keep_raw=KEEP_RAW):
+    '''Fetch datasets concurrently, returns list of fetch() statistics in files order'''
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        return list(ex.map(lambda fn: fetch(pool, fn, retries, backoff, store, keep_raw), files))
+
+def main(site=SITE, user=USER, password=PASS, download_list=DOWNLOAD_LIST, port=PORT, rdw=RDW_MODE,
+         workers=WORKERS, retries=RETRIES, backoff=BACKOFF, stream_store=STREAM_STORE, keep_raw=KEEP_RAW,
+         metrics_report=METRICS_REPORT, timeout=TIMEOUT):
+    store = LogStore(stream_store) if stream_store else None
+    done = store.read_manifest() if store else {}
+    files = []
+    with open(download_list, 'r') as f:
         for line in f:
             if (len(line.strip()) == 0): continue
-            if (os.path.isfile(BIN_DEST+line.strip())): 
+            if (line.strip() in done if store else os.path.isfile(BIN_DEST+line.strip())): 
                 print('Skipping '+line.strip())
                 continue
-            lrecs = retrieve_record_lens(line.strip())
-            if (len(lrecs) > 0):
-                download_bin(line.strip(), lrecs)
-    except ftplib.all_errors as e:
-        print('FTP Error:'+str(e))
+            files.append(line.strip())
+    if (len(files) == 0): return []
+    pool = FTPPool(min(workers, len(files)), site, user, password, port, rdw, timeout)
+    start = time.perf_counter()
+    try:
+        results = download_all(files, pool, workers, retries, backoff, store, keep_raw)
     finally:
-        ftp.quit()     
+        pool.close()
         print('FTP disconnected.')
+    elapsed = time.perf_counter() - start
+    total_bytes = report(results)
+    print('Downloaded {} of {} datasets, {} bytes in {:.1f} s ({:.2f} MB/s)'.format(
+        sum(1 for r in results if not r['error']), len(results), total_bytes, elapsed,
+        total_bytes / elapsed / 1e6 if elapsed > 0 else 0.0))
+    if metrics_report: metrics.report(metrics_report, site=site, datasets=len(results))
+    return results
+
+
+if __name__ == '__main__':
+    main()
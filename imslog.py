@@ -7,11 +7,23 @@ Created on Fri Jul 20 13:35:07 2018
 @email: vaclav.koudelka@ca.com
 Script for transforming downloaded raw log files into basic pandas dataframe
 which are stored in local file system as  HDF files.
+Log files are processed in parallel, one worker process per file:
+    python imslog.py --workers 8
+The same can be done from python with imslog.ingest().
+Time or sequence windows of a log file are read without loading it, through
+its sparse index sidecar:
+    imslog.seek_records('slds/IMS.SLDSP.LOG1', '2018-08-06 12:10', '2018-08-06 12:11')
+    imslog.records_before('slds/IMS.SLDSP.LOG1', '2018-08-06 12:10:17.637857', 20)
+Stage timings and per record type counts of the run are written with --metrics
+(see metrics.py), --profile and --tracemalloc add cProfile and allocation data.
 '''
 
 import pandas as pd
-import sys, os, psutil, time, datetime
-import logspecs
+import numpy as np
+import sys, os, time, datetime, mmap, argparse, struct, hashlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import logspecs, metrics
+from logstore import LogStore, as_list
 
 LOG_PATH = 'slds/'
 HDF_PATH = 'hdf5/logs.h5'
@@ -20,15 +32,299 @@ HDF_PATH = 'hdf5/logs.h5'
 It is used to separate particular log records'''
 DELIMETER = bytes((0xb2, 0x1d, 0x2d))
 
+'''Delimeter search in mapped files is done in chunks of this size so the
+temporary comparison arrays stay small even for multi-GB files'''
+SPLIT_CHUNK = 64 * 1024 * 1024
+
+
+def find_delimeters(buf, chunk=SPLIT_CHUNK):
+    '''Returns int64 array with start positions of all DELIMETER occurences in buf.
+    DELIMETER can't overlap with itself so the result is the same as repeated find().'''
+    data = np.frombuffer(buf, dtype=np.uint8)
+    found = [np.empty(0, dtype=np.int64)]
+    for start in range(0, len(data), chunk):
+        part = data[start:start + chunk + 2]      # two bytes overlap for delimeter on chunk border
+        cand = np.flatnonzero(part[:-2] == DELIMETER[0])
+        cand = cand[(part[cand + 1] == DELIMETER[1]) & (part[cand + 2] == DELIMETER[2])]
+        found.append(cand.astype(np.int64) + start)
+    return np.concatenate(found)
+
+
+def split_records(buf):
+    '''Computes offsets and lengths (NumPy int64 arrays) of records delimited
+    by DELIMETER in buf. Empty records are left out.'''
+    delims = find_delimeters(buf)
+    starts = np.concatenate(([0], delims + len(DELIMETER)))
+    ends = np.concatenate((delims, [len(buf)]))
+    lengths = ends - starts
+    keep = lengths > 0
+    return starts[keep], lengths[keep]
+
+
+class MappedRecords:
+    '''Lazy list of records living in memory mapped log file.
+    Records are returned as memoryview slices, nothing is copied until
+    the caller converts them to bytes.'''
+    def __init__(self, view, offsets, lengths):
+        self.view = view          # memoryview of the whole file
+        self.offsets = offsets    # record start positions in file
+        self.lengths = lengths    # record lengths without delimeter
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return MappedRecords(self.view, self.offsets[i], self.lengths[i])
+        off = int(self.offsets[i])
+        return self.view[off:off + int(self.lengths[i])]
+
+    def __iter__(self):
+        for off, ln in zip(self.offsets.tolist(), self.lengths.tolist()):
+            yield self.view[off:off + ln]
+
+    def tolist(self):
+        '''Copies records into list of bytes - the same as non mapped get_records()'''
+        return [bytes(r) for r in self]
+
+
+'''Record index sidecar - stored next to the log file as <file>.idx.
+Header holds size and mtime of the log file so a stale index is detected,
+fixed width records follow.'''
+INDEX_SUFFIX = '.idx'
+INDEX_MAGIC = b'IMSLIDX1'
+INDEX_HEADER = struct.Struct('<8sQQQ')      # magic, file size, file mtime_ns, record count
+INDEX_DTYPE = np.dtype([('offset', '<i8'), ('length', '<i4'), ('type', 'u1'), ('subtype', 'u1'),
+                        ('sequence', '<u8'), ('tod', '<u8')])
+
+
+def index_path(dsn):
+    return dsn + INDEX_SUFFIX
+
+
+def build_index(buf, offsets, lengths):
+    '''Builds index records for records given by offsets and lengths into buf'''
+    index = np.zeros(len(offsets), dtype=INDEX_DTYPE)
+    index['offset'] = offsets
+    index['length'] = lengths
+    if len(offsets) == 0: return index
+    common = logspecs.common_fields_from_buffer(buf, offsets, lengths)
+    index['type'] = common['type'].codes
+    index['subtype'] = common['subtype'].codes
+    index['sequence'] = common['sequence']
+    index['tod'] = common['tod']
+    return index
+
+
+def write_index(dsn, index):
+    '''Saves index sidecar of the log file, returns False when it can't be written'''
+    st = os.stat(dsn)
+    tmp = index_path(dsn) + '.tmp'
+    try:
+        with open(tmp, 'wb') as f:
+            f.write(INDEX_HEADER.pack(INDEX_MAGIC, st.st_size, st.st_mtime_ns, len(index)))
+            f.write(np.ascontiguousarray(index, dtype=INDEX_DTYPE).tobytes())
+        os.replace(tmp, index_path(dsn))
+    except OSError:
+        return False
+    return True
+
+
+def read_index(dsn):
+    '''Memory maps index sidecar of the log file. Returns None when there is
+    no index or the log file changed since the index was written.'''
+    try:
+        with open(index_path(dsn), 'rb') as f:
+            magic, size, mtime_ns, count = INDEX_HEADER.unpack(f.read(INDEX_HEADER.size))
+        st = os.stat(dsn)
+    except (OSError, struct.error):
+        return None
+    if magic != INDEX_MAGIC or size != st.st_size or mtime_ns != st.st_mtime_ns: return None
+    if count == 0: return np.zeros(0, dtype=INDEX_DTYPE)
+    return np.memmap(index_path(dsn), dtype=INDEX_DTYPE, mode='r', offset=INDEX_HEADER.size, shape=(count,))
+
+
+'''Sparse seek index sidecar - <file>.sdx holds offset, sequence and TOD of every
+SPARSE_STEP-th record and of the last one. TODs are running maximums so the
+index stays sorted even where records carry no clock.'''
+SPARSE_SUFFIX = '.sdx'
+SPARSE_MAGIC = b'IMSLSDX1'
+SPARSE_HEADER = struct.Struct('<8sQQQQ')     # magic, file size, file mtime_ns, entry count, step
+SPARSE_DTYPE = np.dtype([('record', '<i8'), ('offset', '<i8'), ('sequence', '<u8'), ('tod', '<u8')])
+SPARSE_STEP = 1024
+
+
+def sparse_index_path(dsn):
+    return dsn + SPARSE_SUFFIX
+
+
+def build_sparse_index(dsn, step=SPARSE_STEP):
+    '''Sparse index of the log file, taken from its full index sidecar when it is
+    up to date, otherwise from one pass over the mapped file'''
+    index = read_index(dsn)
+    if index is None:
+        tlog = IMSLogDataset(dsn, use_mmap=True)
+        index = build_index(tlog.content if tlog.content is not None else b'', tlog.offsets, tlog.lengths)
+        tlog.close()
+    sparse = np.zeros(0, dtype=SPARSE_DTYPE)
+    if len(index) == 0: return sparse
+    rec = np.unique(np.append(np.arange(0, len(index), step), len(index) - 1))
+    sparse = np.zeros(len(rec), dtype=SPARSE_DTYPE)
+    sparse['record'] = rec
+    sparse['offset'] = np.asarray(index['offset'])[rec]
+    sparse['sequence'] = np.maximum.accumulate(np.asarray(index['sequence'], dtype=np.uint64))[rec]
+    sparse['tod'] = np.maximum.accumulate(np.asarray(index['tod'], dtype=np.uint64))[rec]
+    return sparse
+
+
+def write_sparse_index(dsn, sparse, step=SPARSE_STEP):
+    '''Saves sparse index sidecar of the log file, returns False when it can't be written'''
+    st = os.stat(dsn)
+    tmp = sparse_index_path(dsn) + '.tmp'
+    try:
+        with open(tmp, 'wb') as f:
+            f.write(SPARSE_HEADER.pack(SPARSE_MAGIC, st.st_size, st.st_mtime_ns, len(sparse), step))
+            f.write(np.ascontiguousarray(sparse, dtype=SPARSE_DTYPE).tobytes())
+        os.replace(tmp, sparse_index_path(dsn))
+    except OSError:
+        return False
+    return True
+
+
+def read_sparse_index(dsn):
+    '''Sparse index of the log file or None when it is missing or stale'''
+    try:
+        with open(sparse_index_path(dsn), 'rb') as f:
+            magic, size, mtime_ns, count, step = SPARSE_HEADER.unpack(f.read(SPARSE_HEADER.size))
+            data = f.read(count * SPARSE_DTYPE.itemsize)
+        st = os.stat(dsn)
+    except (OSError, struct.error):
+        return None
+    if magic != SPARSE_MAGIC or size != st.st_size or mtime_ns != st.st_mtime_ns: return None
+    return np.frombuffer(data, dtype=SPARSE_DTYPE)
+
+
+def sparse_index(dsn, step=SPARSE_STEP):
+    '''Sparse index of the log file, built and saved on first use'''
+    sparse = read_sparse_index(dsn)
+    if sparse is None:
+        sparse = build_sparse_index(dsn, step)
+        write_sparse_index(dsn, sparse, step)
+    return sparse
+
+
+def as_tod(when):
+    '''TOD clock value of anything pd.Timestamp accepts'''
+    micros = (pd.Timestamp(when) - pd.Timestamp('1970-01-01')) // pd.Timedelta(1, 'us')
+    return (int(micros) + logspecs.EPOCH70_MICROS) << 12
+
+
+def read_range(dsn, sparse, lo, hi):
+    '''Records of the log file from sparse index entry lo up to entry hi (excluded,
+    len(sparse) means end of file). Only that byte range is mapped.
+    Returns dataframe with blob, offset and common fields.'''
+    begin = int(sparse['offset'][lo]) if lo < len(sparse) else 0
+    end = int(sparse['offset'][hi]) if hi < len(sparse) else os.path.getsize(dsn)
+    if hi <= lo or end <= begin: return offset_frame(b'', np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), 0)
+    aligned = begin - begin % mmap.ALLOCATIONGRANULARITY     # mmap offset must be aligned
+    with open(dsn, 'rb') as f:
+        mapped = mmap.mmap(f.fileno(), end - aligned, access=mmap.ACCESS_READ, offset=aligned)
+    view = memoryview(mapped)[begin - aligned:]
+    try:
+        offsets, lengths = split_records(view)
+        return offset_frame(view, offsets, lengths, begin)
+    finally:
+        view.release()
+        mapped.close()
+
+
+def offset_frame(buf, offsets, lengths, base):
+    '''logspecs.records_frame_from_buffer() plus offset of records in the log
+    file (base is file offset of buf)'''
+    df = logspecs.records_frame_from_buffer(buf, offsets, lengths)
+    df.insert(1, 'offset', offsets + base)
+    return df
+
+
+def filter_records(df, start=None, end=None, seq_from=None, seq_to=None, types=None):
+    keep = np.ones(len(df), dtype=bool)
+    if start is not None: keep &= np.asarray(df['datetime'] >= pd.Timestamp(start))
+    if end is not None: keep &= np.asarray(df['datetime'] < pd.Timestamp(end))
+    if seq_from is not None: keep &= np.asarray(df['sequence'] >= seq_from)
+    if seq_to is not None: keep &= np.asarray(df['sequence'] <= seq_to)
+    if types is not None: keep &= np.asarray(df['type'].astype(str).isin(as_list(types)))
+    return df[keep].reset_index(drop=True)
+
+
+def seek_records(dsn, start=None, end=None, seq_from=None, seq_to=None, types=None):
+    '''Records of the log file with time in [start, end) and sequence in
+    [seq_from, seq_to], optionally of given types only ('42' or list of types).
+    Sparse index is binary searched and only blocks overlapping the window are read.'''
+    sparse = sparse_index(dsn)
+    lo, hi = 0, len(sparse)
+    if start is not None: lo = max(lo, np.searchsorted(sparse['tod'], np.uint64(as_tod(start)), 'left') - 1)
+    if seq_from is not None: lo = max(lo, np.searchsorted(sparse['sequence'], np.uint64(seq_from), 'left') - 1)
+    if end is not None: hi = min(hi, np.searchsorted(sparse['tod'], np.uint64(as_tod(end)), 'left'))
+    if seq_to is not None: hi = min(hi, np.searchsorted(sparse['sequence'], np.uint64(seq_to), 'right'))
+    df = read_range(dsn, sparse, int(lo), int(hi))
+    return filter_records(df, start, end, seq_from, seq_to, types)
+
+
+def records_before(dsn, when, count=20, types=None):
+    '''Last count records (of given types) before time when, e.g. the records
+    preceding an OLDS switch. Blocks are read backwards, twice as many each round.'''
+    sparse = sparse_index(dsn)
+    hi = int(np.searchsorted(sparse['tod'], np.uint64(as_tod(when)), 'left'))
+    span = 1
+    while True:
+        lo = max(hi - span, 0)
+        df = filter_records(read_range(dsn, sparse, lo, hi + 1 if hi < len(sparse) else hi), end=when, types=types)
+        if len(df) >= count or lo == 0: return df.iloc[-count:].reset_index(drop=True)
+        span *= 2
+
+
+def seek(files, start=None, end=None, seq_from=None, seq_to=None, types=None):
+    '''seek_records() over several log files, records get file column'''
+    frames = []
+    for f in files:
+        df = seek_records(f, start, end, seq_from, seq_to, types)
+        df.insert(0, 'file', os.path.basename(f))
+        frames.append(df)
+    if len(frames) == 0: return pd.DataFrame(data=[], columns=['file', 'blob', 'offset'])
+    return pd.concat(frames, ignore_index=True)
+
     
 class IMSLogDataset:
-    '''Class for handling the log files stored on harddrive'''
-    def __init__(self, dsn):
+    '''Class for handling the log files stored on harddrive.
+    With use_mmap=True the file is memory mapped instead of read into memory,
+    get_records() then returns MappedRecords and offsets/lengths hold
+    the record positions.
+    With use_index=True (implies use_mmap) record positions, types, sequence
+    numbers and tods are taken from <file>.idx sidecar, which is built and
+    saved on the first open, so later opens don't scan the file at all.'''
+    def __init__(self, dsn, use_mmap=False, use_index=False):
         self.dsn = dsn
         self.content = bytearray()
         self.recs = None
-        self.load_blob_to_memory()
+        self.use_mmap = use_mmap or use_index
+        self.mapped = None          # mmap object when use_mmap
+        self.offsets = None         # record offsets, only filled when use_mmap
+        self.lengths = None         # record lengths, only filled when use_mmap
+        self.index = None           # INDEX_DTYPE records, only filled when use_index
+        if self.use_mmap:
+            self.map_blob()
+        else:
+            self.load_blob_to_memory()
+        if use_index:
+            self.index = read_index(dsn)
+            if self.index is not None:
+                self.offsets = np.asarray(self.index['offset'], dtype=np.int64)
+                self.lengths = np.asarray(self.index['length'], dtype=np.int64)
         self.get_records()
+        if use_index and self.index is None:
+            self.index = build_index(self.content if self.content is not None else b'',
+                                     self.offsets, self.lengths)
+            write_index(dsn, self.index)
         self.clear_blob_from_memory()
         
     def __del__(self):
@@ -41,18 +337,34 @@ class IMSLogDataset:
             self.content = f.read()
             #print('File loaded - {} bytes'.format(len(self.content)))
     
+    def map_blob(self):
+        '''Maps the log file into memory, pages are read by OS on demand'''
+        with open(self.dsn, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0: return  # empty file can't be mapped
+            self.mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.content = memoryview(self.mapped)
+
     def clear_blob_from_memory(self):
         '''Memory saver - get rid of the binary content when it' not needed'''
+        if self.use_mmap: return   # mapped records still point into content
         self.content = None
 
+    def close(self):
+        '''Unmaps the log file. Record views handed out before must not be used after this.'''
+        self.recs = None
+        self.content = None
+        if self.mapped is not None:
+            try: self.mapped.close()
+            except BufferError: pass   # some record view still alive, gc will unmap it
+            self.mapped = None
+
     def get_record_count(self):
-        print('content count: {}'.format(sys.getrefcount(self.recs)))
-        print('content size: {}'.format(sys.getsizeof(self.recs)))
         return len(self.get_records())
     
     def get_records(self):
         ''' Transform blob of binary data into records '''
         if self.recs is not None: return self.recs   # job was done before
+        if self.use_mmap: return self.get_mapped_records()
         self.recs = []                               # initialize records
         if len(self.content) == 0: return self.recs  # don't bother with empty file
 
@@ -67,48 +379,200 @@ class IMSLogDataset:
                     self.recs.append(self.content[pos:fi])
                 pos = fi + 3  # three for delimeter
         return self.recs
+
+    def get_mapped_records(self):
+        ''' Vectorized split of mapped file into MappedRecords '''
+        if self.offsets is not None:               # positions known from index sidecar
+            self.recs = MappedRecords(self.content if self.content is not None else memoryview(b''),
+                                      self.offsets, self.lengths)
+            return self.recs
+        if self.content is None or len(self.content) == 0:
+            self.offsets = np.empty(0, dtype=np.int64)
+            self.lengths = np.empty(0, dtype=np.int64)
+            self.recs = MappedRecords(memoryview(b''), self.offsets, self.lengths)
+            return self.recs
+        self.offsets, self.lengths = split_records(self.content)
+        self.recs = MappedRecords(self.content, self.offsets, self.lengths)
+        return self.recs
         
     def get_record_by_index(self, i):
-        assert(i > len(self.recs))
+        assert(0 <= i < len(self.recs))
         return self.recs[i]
     
     def get_hexpos_by_index(self, i):
-        assert(i > len(self.recs))
+        assert(0 <= i < len(self.recs))
+        if self.offsets is not None: return int(self.offsets[i])
         pos = 0
         for r in range(i): pos += len(self.recs[r]) + 3  # three is for delim
         return pos
+
+    def find_records(self, tp, subtype=None):
+        '''Numbers of records of given type and subtype, e.g. find_records('67', 'ff').
+        Needs use_index.'''
+        assert(self.index is not None)
+        mask = self.index['type'] == int(tp, 16)
+        if subtype is not None: mask &= self.index['subtype'] == int(subtype, 16)
+        return np.flatnonzero(mask)
     
 
-# let's measuru exec time
-start_time = time.time()
-process = psutil.Process(os.getpid())
+def load_log_file(dsn):
+    '''Ingest worker - splits one log file and extracts fields common for all
+    log types. Returns dataframe with blob column and common fields.'''
+    with metrics.stage('split', nbytes=os.path.getsize(dsn)) as st:
+        tlog = IMSLogDataset(dsn, use_mmap=True)
+        st.records = len(tlog.offsets)
+    df = logspecs.records_frame_from_buffer(tlog.content, tlog.offsets, tlog.lengths)
+    metrics.by_type('records', df['type'], tlog.lengths)
+    tlog.close()
+    return df
 
-# init counter
-count = 0
 
-# initialize empty dataframe
-ult_df = pd.DataFrame(data=[], columns=[])
+def describe_log_file(dsn, df):
+    '''Manifest entry of processed log file'''
+    st = os.stat(dsn)
+    sha1 = hashlib.sha1()
+    with open(dsn, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''): sha1.update(chunk)
+    entry = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'sha1': sha1.hexdigest(),
+             'records': len(df), 'seq_min': None, 'seq_max': None}
+    if len(df) > 0:
+        entry['seq_min'] = int(df['sequence'].min())
+        entry['seq_max'] = int(df['sequence'].max())
+    return entry
 
-# go through binary files in inuput directory and transform them into dataframe
-for f in os.listdir(LOG_PATH):
-    count += 1
-    tlog = IMSLogDataset(LOG_PATH+f)
-    tdf = pd.DataFrame(data=tlog.get_records(), columns=['blob'])
-    tlog = None  # force him to vanish
-        
-    ult_df = ult_df.append(tdf)
 
-    print('{} Memory usage total: {} Size of ult_df: {} Difference: {}'.format(count, process.memory_info().rss,
-          sys.getsizeof(ult_df), process.memory_info().rss-sys.getsizeof(ult_df)))
+def ingest_log_file(dsn):
+    '''Incremental ingest worker - load_log_file plus manifest entry of the file'''
+    df = load_log_file(dsn)
+    return df, describe_log_file(dsn, df)
 
 
-for group, frame in ult_df.groupby('type'):
-    print('Type {} has count {}'.format(group, frame.shape[0]))
-    
+def log_file_changed(dsn, entry):
+    '''Cheap check against manifest entry, content hash is compared only after processing'''
+    if entry is None: return True
+    st = os.stat(dsn)
+    return st.st_size != entry.get('size') or st.st_mtime_ns != entry.get('mtime_ns')
+
+
+def list_log_files(log_path=LOG_PATH):
+    '''Log files in input directory, sorted by name so the result does not depend on listdir order.
+    Index sidecars, temporary files and .part files of downloads in progress are skipped.'''
+    return sorted(os.path.join(log_path, f) for f in os.listdir(log_path)
+                  if os.path.isfile(os.path.join(log_path, f))
+                  and not f.endswith((INDEX_SUFFIX, SPARSE_SUFFIX, '.tmp', '.part')))
+
+
+def load_log_files(files, workers=None, worker=load_log_file):
+    '''Runs worker (load_log_file by default) over files on a process pool
+    (one task per file) and yields (file, result) as the files get done.
+    workers=1 processes files one by one in this process. Metrics of the
+    workers are merged into metrics of this process.'''
+    if workers == 1:
+        for f in files: yield f, worker(f)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(metrics.collect, worker, f): f for f in files}
+        for fut in as_completed(futures):
+            res, snap = fut.result()
+            metrics.merge(snap)
+            yield futures[fut], res
+
+
+def ingest(log_path=LOG_PATH, hdf_path=HDF_PATH, workers=None, store_path=None, full=False, merge=False):
+    '''Transforms all log files in log_path into one dataframe with common
+    fields and saves it in hdf_path. Returns the dataframe.
+    With store_path the records of each file are written to partitioned LogStore
+    as soon as the file is processed, no big dataframe is built and None is returned.
+    Store ingest is incremental - only files which are new or changed since the
+    last run (see store manifest) are processed unless full is set.
+    With merge the records of all files are merged in TOD order and duplicates
+    of overlapping files are dropped (see logmerge) before saving to hdf_path.'''
+    start_time = time.time()
+    files = list_log_files(log_path)
+    if store_path is not None:
+        ingest_to_store(files, LogStore(store_path), workers, full)
+        print('All done, execution time: {}'.format(datetime.timedelta(seconds=time.time() - start_time)))
+        return None
+
+    if merge:
+        import logmerge       # logmerge imports this module
+        merger = logmerge.LogMerger(files)
+        parts = list(merger.frames())
+        print(merger.report().to_string(index=False))
+    else:
+        frames = {}
+        for count, (f, tdf) in enumerate(load_log_files(files, workers), 1):
+            frames[f] = tdf
+            print('{}/{} {} - {} records, elapsed {}'.format(count, len(files), f, len(tdf),
+                  datetime.timedelta(seconds=time.time() - start_time)))
+            sys.stdout.flush()
+        parts = [frames[f] for f in files]
+        frames = None
+
+    # one concatenation in file name order instead of growing the dataframe per file
+    if len(parts) == 0: ult_df = pd.DataFrame(data=[], columns=['blob'])
+    else: ult_df = pd.concat(parts, ignore_index=True)
+    parts = None
+
+    if 'type' in ult_df:
+        for group, frame in ult_df.groupby('type', observed=True):
+            print('Type {} has count {}'.format(group, frame.shape[0]))
+
+    # save final dataframe in hdf format, fixed format can't hold categoricals
+    with metrics.stage('hdf_write', records=len(ult_df)):
+        store = pd.HDFStore(hdf_path)
+        store['df'] = ult_df.astype({c: object for c in ('type', 'subtype') if c in ult_df})
+        store.close()
+
+    print('All done, execution time: {}'.format(datetime.timedelta(seconds=time.time() - start_time)))
+    return ult_df
+
+
+def ingest_to_store(files, store, workers=None, full=False):
+    '''Processes new and changed log files into the store and keeps its manifest.
+    Manifest is saved after every file so interrupted run continues where it stopped.'''
+    start_time = time.time()
+    manifest = store.read_manifest()
+    todo = [f for f in files if full or log_file_changed(f, manifest.get(os.path.basename(f)))]
+    print('{} log files, {} new or changed'.format(len(files), len(todo)))
+    for count, (f, (tdf, entry)) in enumerate(load_log_files(todo, workers, ingest_log_file), 1):
+        key = os.path.basename(f)
+        old = manifest.get(key)
+        if full or old is None or old.get('sha1') != entry['sha1']:
+            store.write(tdf, f, entry=entry)   # saves the entry with the new files
+            status = 'stored'
+        else:
+            store.update_manifest(f, entry)
+            status = 'unchanged content'   # only touched, records are in the store already
+        print('{}/{} {} - {} records {}, elapsed {}'.format(count, len(todo), f, len(tdf), status,
+              datetime.timedelta(seconds=time.time() - start_time)))
+        sys.stdout.flush()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Transforms downloaded raw log files into HDF file.')
+    parser.add_argument('--log-path', default=LOG_PATH, help='directory with downloaded log files')
+    parser.add_argument('--hdf-path', default=HDF_PATH, help='output HDF file')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of worker processes, default is number of cpus')
+    parser.add_argument('--store', default=None,
+                        help='write into partitioned log store in this directory instead of HDF file')
+    parser.add_argument('--full', action='store_true',
+                        help='with --store reprocess all log files, not only new and changed ones')
+    parser.add_argument('--merge', action='store_true',
+                        help='merge log files in TOD order and drop duplicate records (HDF output only)')
+    parser.add_argument('--metrics', default=None,
+                        help='write stage metrics of the run into this JSON (or .csv) file')
+    parser.add_argument('--profile', action='store_true', help='with --metrics also save cProfile stats')
+    parser.add_argument('--tracemalloc', action='store_true', help='with --metrics also trace memory allocations')
+    args = parser.parse_args(argv)
+    if args.metrics: metrics.enable(args.profile, args.tracemalloc)
+    try:
+        with metrics.stage('ingest'):
+            ingest(args.log_path, args.hdf_path, args.workers, args.store, args.full, args.merge)
+    finally:
+        if args.metrics: metrics.report(args.metrics, log_path=args.log_path, workers=args.workers)
 
-# save final dataframe in hdf format
-store = pd.HDFStore(HDF_PATH)
-store['df'] = ult_df
-store.close()
 
-print('All done, execution time: {}'.format(datetime.timedelta(seconds=time.time() - start_time)))
\ No newline at end of file
+if __name__ == '__main__':
+    main()
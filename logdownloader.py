@@ -7,6 +7,7 @@ Created on Thu Jul 19 15:02:05 2018
 @email: vaclav.koudelka@ca.com
 LogDownloader is helper class for storing log files in local file system. Each
 log file is saved in separate file and records are delimited by DELIMETER constant.
+RDWDownloader produces the same files from single SITE RDW binary download.
 '''
 
 
@@ -23,6 +24,9 @@ MVSDELIMETER = (bytes((0x0D, 0x15)),bytes((0x0D, 0x25)))
 class LogDownloader:
     ''' Mainframe download helper class
     Enables to track record length of variable length sequential datasets.
+    Every block is assembled from memoryview slices and written with one fd.write.
+    Record end which is closer than two bytes to the block end is decided only
+    when the next block arrives, so fake delimeter check always sees both bytes.
     '''
     
     def  __init__(self, fd, lrecs):
@@ -32,10 +36,20 @@ class LogDownloader:
         self.current_position = 0             # current position in buffer
         self.bytes_to_record_end = lrecs[0]   # Bytes left to write to output record 
         self.bytes_flushed = 0                # Bytes flushed after error
+        self.carry = b''                      # Bytes behind undecided record end (lookahead)
     
     def done(self):
         ''' Healthcheck information. Flushed bytes = 0 indicates all went well. '''
+        self.finish()
         print('Download finished. Flushed bytes: {}'.format(self.bytes_flushed))
+
+    def finish(self):
+        ''' End of data - record end waiting for lookahead is a real one '''
+        while len(self.carry) > 0:
+            carry, self.carry = self.carry, b''
+            self.fd.write(DELIMETER)
+            self.bytes_to_record_end = self.get_next_lrec()
+            self.write(carry)
     
     def get_next_lrec(self):
         self.current_position += 1
@@ -43,47 +57,131 @@ class LogDownloader:
         return self.lrecs[self.current_position]
     
     def prolong_next_record(self):
-        self.lrecs[self.current_position+1] += 2
+        if (self.current_position + 1 < len(self.lrecs)):
+            self.lrecs[self.current_position+1] += 2
     
     def write(self, block):
         if (self.bytes_to_record_end == -1):
             self.bytes_flushed += len(block)
             return
-        if (self.bytes_to_record_end > len(block)):
-            # whole block is fitting to output record
-            self.fd.write(block)
-            self.bytes_to_record_end -= len(block)
-            if __debug__: print('writing whole block '+str(len(block)))
-        else:
-            # block needs to be splitted with delimeter
-            bytes_written = 0
-            while (self.bytes_to_record_end < (len(block) - bytes_written)):
-                # write what you can and terminate it with delimeter
-                self.fd.write(block[bytes_written:(bytes_written + self.bytes_to_record_end)])
-                bytes_written += self.bytes_to_record_end
-                if not next_bytes_delimeter(block[bytes_written:]):
-                    self.fd.write(DELIMETER)
-                else:
-                    # fake delimeter in file -> next record must be 2 bytes longer
-                    self.prolong_next_record()                
-                if __debug__: 
-                    print('writing piece of block {}, left to write {}'.format(self.bytes_to_record_end, 
-                                                                               (len(block) - bytes_written)))                
-                self.bytes_to_record_end = self.get_next_lrec()
-                if (self.bytes_to_record_end == -1): 
-                    self.bytes_flushed += (len(block) - bytes_written)
-                    break                
+        data = self.carry + block if self.carry else block
+        self.carry = b''
+        mv = memoryview(data)
+        size = len(data)
+        out = []
+        pos = 0
+        while True:
+            end = pos + self.bytes_to_record_end
+            if (end > size):
+                # record continues in next block
+                out.append(mv[pos:])
+                self.bytes_to_record_end = end - size
+                break
+            out.append(mv[pos:end])
+            if (size - end < 2):
+                # can't tell fake delimeter yet, wait for next block
+                self.carry = bytes(mv[end:])
+                self.bytes_to_record_end = 0
+                break
+            pos = end
+            if not next_bytes_delimeter(mv[pos:pos+2]):
+                out.append(DELIMETER)
+            else:
+                # fake delimeter in file -> next record must be 2 bytes longer
+                self.prolong_next_record()
+            self.bytes_to_record_end = self.get_next_lrec()
+            if (self.bytes_to_record_end == -1):
+                self.bytes_flushed += size - pos
+                break
+        self.fd.write(b''.join(out))
+
+class RDWDownloader:
+    ''' Mainframe download helper class for SITE RDW transfers
+    Each record comes prefixed by its record descriptor word (2 bytes big-endian
+    length including the RDW itself, 2 bytes zero). RDWs are parsed on the fly
+    and replaced by DELIMETER, so output matches LogDownloader's and no text-mode
+    pass for record lengths is needed. RDW split across blocks is kept in rdw.
+    Bad length or nonzero bytes 2-3 (e.g. spanned VBS segment descriptor) stop
+    the output, the rest of the data counts as flushed.
+    '''
+
+    def __init__(self, fd):
+        self.fd = fd                          # Opened file for writing output
+        self.rdw = b''                        # Partial record descriptor word
+        self.bytes_to_record_end = 0          # Bytes left to write to output record
+        self.record_count = 0                 # Records started so far
+        self.bytes_flushed = 0                # Bytes flushed after error
 
-            # write the rest                
-            self.fd.write(block[bytes_written:])
-            self.bytes_to_record_end -= (len(block) - bytes_written)
-            if __debug__: print('writing rest '+str(len(block) - bytes_written))
+    def done(self):
+        ''' Healthcheck information. Flushed bytes = 0 indicates all went well. '''
+        self.finish()
+        print('Download finished. Records: {}, flushed bytes: {}'.format(self.record_count, self.bytes_flushed))
+
+    def finish(self):
+        ''' End of data - unfinished record or RDW counts as flushed '''
+        if (self.bytes_to_record_end > 0 or len(self.rdw) > 0):
+            self.bytes_flushed += self.bytes_to_record_end + len(self.rdw)
+            self.bytes_to_record_end = 0
+            self.rdw = b''
+
+    def write(self, block):
+        if (self.bytes_to_record_end == -1):
+            self.bytes_flushed += len(block)
+            return
+        mv = memoryview(block)
+        size = len(block)
+        out = []
+        pos = 0
+        while (pos < size):
+            if (self.bytes_to_record_end > 0):
+                n = min(self.bytes_to_record_end, size - pos)
+                out.append(mv[pos:pos+n])
+                pos += n
+                self.bytes_to_record_end -= n
+                continue
+            # record descriptor word expected
+            need = 4 - len(self.rdw)
+            self.rdw += bytes(mv[pos:pos+need])
+            pos += need
+            if (len(self.rdw) < 4): break
+            lrec = int.from_bytes(self.rdw[:2], 'big') - 4
+            flags = self.rdw[2:]
+            self.rdw = b''
+            if (lrec < 0 or flags != b'\x00\x00'):
+                # not an RDW (bytes 2-3 are zero, nonzero is e.g. VBS segment descriptor
+                # or misaligned stream), output can't be trusted anymore
+                self.bytes_to_record_end = -1
+                self.bytes_flushed += max(size - pos, 0) + 4
+                break
+            if (self.record_count > 0): out.append(DELIMETER)
+            self.record_count += 1
+            self.bytes_to_record_end = lrec
+        self.fd.write(b''.join(out))
 
 def next_bytes_delimeter(ba):
-    if (len(ba) < 2): return False   # todo could be in next block
+    if (len(ba) < 2): return False   # write() makes sure two bytes are available except at data end
     for d in MVSDELIMETER:
         if (ba[:2] == d): return True
     return False
-    
-        
-        
\ No newline at end of file
+
+
+def benchmark(record_count=200000, max_lrec=2000, block_size=8192, seed=0):
+    ''' Throughput of LogDownloader.write on synthetic records fed in FTP sized blocks.
+    Returns MB/s of downloaded data. '''
+    import io, random, time
+    rnd = random.Random(seed)
+    lrecs = [rnd.randint(1, max_lrec) for _ in range(record_count)]
+    data = bytes(rnd.getrandbits(8) for _ in range(max_lrec)) * (sum(lrecs) // max_lrec + 1)
+    data = data[:sum(lrecs)]
+    ld = LogDownloader(io.BytesIO(), lrecs)
+    start = time.perf_counter()
+    for i in range(0, len(data), block_size):
+        ld.write(data[i:i+block_size])
+    ld.finish()
+    elapsed = time.perf_counter() - start
+    return len(data) / elapsed / 1e6
+
+
+if __name__ == '__main__':
+    for bs in (1024, 8192, 65536):
+        print('block size {:6d}: {:8.1f} MB/s'.format(bs, benchmark(block_size=bs)))
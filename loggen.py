@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Generator of synthetic SLDS files. Real log files can't be shared, these can.
+Records are laid out as described in logspecs - x'07' accounting records,
+x'50' database updates with dborg/dsorg/call flags, x'42' OLDS switches and
+x'67' ff service trace records, some of them DEADLOCK records per deadlock_map.
+Other record types carry random payload and one of few SUBTYPES. Every record
+ends with valid TOD clock and sequence number and records are separated by
+DELIMETER, so the files look exactly like those downloaded by ftpdown.py.
+
+    python loggen.py slds/SYNTH.LOG --size 100
+'''
+
+import random, struct, argparse, datetime
+import logspecs
+from logdownloader import DELIMETER
+
+'''Record type mix - type byte and its relative frequency'''
+RECORD_MIX = {0x50: 40, 0x07: 8, 0x42: 1, 0x67: 3,
+              0x31: 10, 0x35: 10, 0x36: 10, 0x03: 8, 0x5f: 6, 0x08: 4}
+
+'''Subtypes of record types without layout in logspecs, real logs use a few per type'''
+SUBTYPES = {0x31: [0x00, 0x01], 0x35: [0x00, 0x01, 0x04], 0x36: [0x00, 0x01],
+            0x03: [0x00], 0x5f: [0x00, 0x03, 0x04], 0x08: [0x00]}
+
+'''Share of x'67' ff records which are DEADLOCK records'''
+DEADLOCK_SHARE = 0.3
+
+'''Default time of the first record'''
+START = datetime.datetime(2018, 8, 6)
+
+IMSIDS = ['IMS1', 'IMS2', 'IMS3']
+PSBS = ['P147UMPP', 'P147UBMP', 'PAYROLL1', 'PAYROLL2', 'ORDERENT', 'ORDERINQ', 'STOCKUPD', 'CUSTMAIN']
+TRANS = ['TR147UMP', 'TR147UBM', 'PAYTRAN1', 'PAYTRAN2', 'ORDENTRY', 'ORDINQRY', 'STOCKTRN', 'CUSTTRAN']
+DBDS = ['BA1P0050', 'FFIP0050', 'FFIP0051', 'CUSTDB01', 'ORDERDB1', 'STOCKDB1']
+JOBS = ['IMSMPP01', 'IMSMPP02', 'IMSBMP01', 'PAYRUN01']
+STEPS = ['REGION', 'STEP01', 'BMPSTEP']
+SNIDS = ['SNP1', 'SNP2', 'DLCK']
+ABENDS = ['0777', '0775', '0711', '3303']
+SNAPS = ['DUMPSNAP', 'LATCHSNP', 'TRACESNP']
+
+
+def tod_clock(dt):
+    '''datetime to 64bits TOD clock value - reverse of logspecs.tod2datetime'''
+    micros = int((dt - datetime.datetime(1970, 1, 1)).total_seconds() * 1000000)
+    return (micros + logspecs.EPOCH70_MICROS) << 12
+
+
+def ebcdic(text, length):
+    '''Text field of given length in EBCDIC, padded by blanks'''
+    return text.ljust(length)[:length].encode('cp500')
+
+
+class SLDSGenerator:
+    '''Makes records of synthetic log, sequence numbers and clocks grow record by record.
+    x'42' and x'50' records carry imsid, random one of IMSIDS when it is None.'''
+    def __init__(self, seed=0, start=START, interval_us=2000, mix=RECORD_MIX, imsid=None):
+        self.rnd = random.Random(seed)
+        self.imsid = imsid
+        self.sequence = 1
+        self.tod = tod_clock(start)
+        self.interval = interval_us << 12      # average TOD distance of two records
+        self.types = list(mix)
+        self.weights = [mix[t] for t in self.types]
+
+    def put(self, rec, spec, **values):
+        '''Writes values of fields given by log_items like spec into bytearray rec'''
+        for key, val in values.items():
+            it = spec[key]
+            if it['type'] == 'txt':
+                rec[it['off_start']:it['off_end']] = ebcdic(val, it['off_end'] - it['off_start'])
+            elif it['type'] == 'int':
+                rec[it['off_start']:it['off_end']] = val.to_bytes(it['off_end'] - it['off_start'], 'big')
+            else:
+                rec[it['off_start']] = val
+
+    def flag(self, flags):
+        return self.rnd.choice([f.value for f in flags])
+
+    def body(self, tp):
+        '''Record without trailing clock and sequence'''
+        rnd = self.rnd
+        if tp == 0x07:
+            rec = bytearray(rnd.randbytes(0x1a4 + rnd.randint(0, 64)))
+            rec[0] = tp
+            i = rnd.randrange(len(PSBS))
+            totio = [rnd.randint(0, 5000) for _ in range(4)]
+            self.put(rec, logspecs.log_items['07'], psb=PSBS[i], tran=TRANS[i], job=rnd.choice(JOBS),
+                     step=rnd.choice(STEPS), extime=rnd.randint(1000, 50000000),
+                     ccode=0 if rnd.random() < 0.95 else rnd.choice([0x777, 0x775, 0xc4]),
+                     dlicnt=rnd.randint(0, 20000), vsamrio=totio[0], vsamwio=totio[1],
+                     osamrio=totio[2], osamwio=totio[3], totio=sum(totio),
+                     iotime=sum(totio) * rnd.randint(100, 3000), lktime=rnd.randint(0, 1000000))
+        elif tp == 0x50:
+            rec = bytearray(rnd.randbytes(0x40 + rnd.randint(16, 1200)))
+            rec[0], rec[1] = tp, rnd.choice([0x01, 0x02, 0x03])
+            self.put(rec, logspecs.log_items['50'], imsid=self.imsid or rnd.choice(IMSIDS), pgm=rnd.choice(PSBS),
+                     dbd=rnd.choice(DBDS), rba=rnd.randrange(0, 1 << 30) * 4,
+                     call=self.flag(logspecs.log50CallFlag), dborg=self.flag(logspecs.log50DborgFlag),
+                     dsorg=self.flag(logspecs.log50DsorgFlag))
+        elif tp == 0x42:
+            rec = bytearray(rnd.randbytes(0x100))
+            rec[0], rec[1] = tp, 0x00
+            self.put(rec, logspecs.log_items['42'], imsid=self.imsid or rnd.choice(IMSIDS))
+        elif tp == 0x67:
+            rec = bytearray(rnd.randbytes(700 + rnd.randint(0, 300)))
+            rec[0], rec[1] = tp, 0xff
+            deadlock = rnd.random() < DEADLOCK_SHARE
+            self.put(rec, logspecs.log_items['67']['ff'], snid='DLCK' if deadlock else rnd.choice(SNIDS[:2]),
+                     abno='0777' if deadlock else rnd.choice(ABENDS),
+                     name='DEADLOCK' if deadlock else rnd.choice(SNAPS))
+            if deadlock:
+                w, b = rnd.sample(range(len(PSBS)), 2)
+                self.put(rec, logspecs.deadlock_map, dmb=rnd.choice(DBDS),
+                         waiter_imsid=rnd.choice(IMSIDS), waiter_tran=TRANS[w], waiter_psb=PSBS[w],
+                         waiter_pcb=rnd.choice(DBDS), waiter_pst=rnd.randint(1, 200),
+                         blockr_imsid=rnd.choice(IMSIDS), blockr_tran=TRANS[b], blockr_psb=PSBS[b],
+                         blockr_pcb=rnd.choice(DBDS), blockr_pst=rnd.randint(1, 200))
+        else:
+            rec = bytearray(rnd.randbytes(rnd.randint(32, 400)))
+            rec[0], rec[1] = tp, rnd.choice(SUBTYPES.get(tp, [0x00]))
+        return rec
+
+    def record(self):
+        '''Next record of the log'''
+        tp = self.rnd.choices(self.types, self.weights)[0]
+        self.tod += self.rnd.randint(1, 2 * self.interval)
+        while True:
+            rec = self.body(tp) + struct.pack('>QQ', self.tod, self.sequence)
+            if DELIMETER not in rec: break     # random payload must not look like delimeter
+        self.sequence += 1
+        return bytes(rec)
+
+    def records(self, count):
+        for _ in range(count): yield self.record()
+
+
+def generate(dsn, size_mb=None, count=None, seed=0, start=START, imsid=None):
+    '''Writes synthetic log file of at least size_mb megabytes or count records.
+    Returns list of record lengths.'''
+    assert (size_mb is not None or count is not None)
+    gen = SLDSGenerator(seed, start, imsid=imsid)
+    limit = int(size_mb * 1e6) if size_mb is not None else None
+    lrecs = []
+    written = 0
+    with open(dsn, 'wb') as f:
+        while (count is None or len(lrecs) < count) and (limit is None or written < limit):
+            rec = gen.record()
+            if len(lrecs) > 0:
+                f.write(DELIMETER)
+                written += len(DELIMETER)
+            f.write(rec)
+            written += len(rec)
+            lrecs.append(len(rec))
+    return lrecs
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Writes synthetic SLDS file with DELIMETER separated records.')
+    parser.add_argument('dsn', help='output file')
+    parser.add_argument('--size', type=float, default=None, help='file size in MB (default 10)')
+    parser.add_argument('--count', type=int, default=None, help='number of records instead of size')
+    parser.add_argument('--seed', type=int, default=0, help='random seed, the same seed gives the same file')
+    parser.add_argument('--start', default=START.isoformat(), help='time of the first record')
+    parser.add_argument('--imsid', default=None, help='IMS id of the log (default random per record)')
+    args = parser.parse_args(argv)
+    if args.size is None and args.count is None: args.size = 10
+    lrecs = generate(args.dsn, args.size, args.count, args.seed,
+                     datetime.datetime.fromisoformat(args.start), args.imsid)
+    print('{} - {} records, {} bytes'.format(args.dsn, len(lrecs), sum(lrecs) + len(DELIMETER) * (len(lrecs) - 1)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+K-way merge of log files of one or more IMS systems into one timeline ordered
+by TOD (then IMS id and sequence number). Every input file is mapped and read
+chunk by chunk, so memory per input stays constant. Records already seen
+(the same IMS id and sequence number - overlapping archive datasets or
+re-downloaded generations) are dropped. Seen sequence numbers are kept per
+IMS system as sorted ranges, which also gives the sequence gaps.
+
+    python logmerge.py slds/IMS.SLDSP.LOG1 slds/IMS.SLDSP.LOG2 --output slds/MERGED
+'''
+
+import pandas as pd
+import numpy as np
+import os, mmap, heapq, bisect, argparse, collections
+import logspecs
+from imslog import find_delimeters, DELIMETER
+from logstore import add_imsid
+
+'''Bytes of log file split into records at once'''
+READ_CHUNK = 4 * 1024 * 1024
+
+'''Records looked at when IMS id of a log file is guessed'''
+IMSID_SAMPLE = 10000
+
+'''Records per dataframe of LogMerger.frames()'''
+BATCH_SIZE = 100000
+
+
+class RangeSet:
+    '''Set of integers kept as sorted disjoint ranges [start, end], e.g. sequence
+    numbers of one IMS system - mostly one range per log, whatever its size'''
+    def __init__(self):
+        self.starts = []
+        self.ends = []
+
+    def __contains__(self, x):
+        i = bisect.bisect_right(self.starts, x) - 1
+        return i >= 0 and x <= self.ends[i]
+
+    def add(self, x):
+        '''Adds x, returns False when it was in the set already'''
+        i = bisect.bisect_right(self.starts, x) - 1
+        if i >= 0 and x <= self.ends[i]: return False
+        joins_left = i >= 0 and self.ends[i] == x - 1
+        joins_right = i + 1 < len(self.starts) and self.starts[i + 1] == x + 1
+        if joins_left and joins_right:
+            self.ends[i] = self.ends[i + 1]
+            del self.starts[i + 1], self.ends[i + 1]
+        elif joins_left:
+            self.ends[i] = x
+        elif joins_right:
+            self.starts[i + 1] = x
+        else:
+            self.starts.insert(i + 1, x)
+            self.ends.insert(i + 1, x)
+        return True
+
+    def __len__(self):
+        return sum(e - s + 1 for s, e in zip(self.starts, self.ends))
+
+    def ranges(self):
+        return list(zip(self.starts, self.ends))
+
+    def gaps(self):
+        '''Missing ranges [start, end] between the first and the last number'''
+        return [(e + 1, s - 1) for e, s in zip(self.ends[:-1], self.starts[1:])]
+
+
+def file_imsid(dsn, sample=IMSID_SAMPLE):
+    '''IMS id of log file - the most frequent one among its first records
+    carrying IMS id (see logstore.IMSID_FIELDS), file name when there is none'''
+    counts = collections.Counter()
+    for batch in file_batches(dsn):
+        add_imsid(batch)
+        counts.update(batch['imsid'].dropna())
+        if sum(counts.values()) >= sample: break
+    if len(counts) == 0: return os.path.basename(dsn)
+    return counts.most_common(1)[0][0].rstrip()
+
+
+def file_batches(dsn, chunk=READ_CHUNK):
+    '''Generator of dataframes (blob and common fields) with records of mapped
+    log file in file order, about chunk bytes each'''
+    with open(dsn, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0: return
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    view = memoryview(mapped)
+    pos = 0
+    try:
+        while pos < size:
+            end = min(pos + chunk, size)
+            delims = find_delimeters(view[pos:min(end + len(DELIMETER) - 1, size)])
+            if end < size:
+                if len(delims) == 0 or delims[-1] == 0:   # record longer than chunk
+                    chunk *= 2
+                    continue
+                end = pos + int(delims[-1])   # unfinished record goes to the next chunk
+                delims = delims[:-1]
+            starts = np.concatenate(([0], delims + len(DELIMETER))) + pos
+            ends = np.append(delims + pos, end)
+            keep = ends > starts
+            offsets, lengths = starts[keep], (ends - starts)[keep]
+            pos = end + len(DELIMETER)
+            if len(offsets) == 0: continue
+            yield logspecs.records_frame_from_buffer(view, offsets, lengths)
+    finally:
+        view.release()
+        mapped.close()
+
+
+def file_records(dsn, imsid, chunk=READ_CHUNK):
+    '''Generator of (tod, imsid, sequence, file, blob) of log file records in file order.
+    Records without clock get the clock of the record before so they keep their place.'''
+    name = os.path.basename(dsn)
+    last_tod = 0
+    for df in file_batches(dsn, chunk):
+        tods = np.maximum.accumulate(np.maximum(df['tod'].values, np.uint64(last_tod)))
+        last_tod = int(tods[-1])
+        for tod, seq, blob in zip(tods.tolist(), df['sequence'].tolist(), df['blob'].tolist()):
+            yield tod, imsid, seq, name, blob
+
+
+class LogMerger:
+    '''K-way merge of log files with deduplication and sequence gap report'''
+    def __init__(self, files, imsids=None, dedup=True):
+        self.files = list(files)
+        self.imsids = {f: (imsids or {}).get(f) or file_imsid(f) for f in self.files}
+        self.dedup = dedup
+        self.reset()
+
+    def reset(self):
+        self.seen = collections.defaultdict(RangeSet)      # imsid -> sequence numbers
+        self.duplicates = collections.Counter()            # imsid -> dropped records
+        self.merged = 0
+
+    def records(self):
+        '''Generator of (tod, imsid, sequence, file, blob) in global order, duplicates dropped.
+        Every merge starts from scratch, report() and gaps() describe the last one.'''
+        self.reset()
+        streams = [file_records(f, self.imsids[f]) for f in self.files]
+        for rec in heapq.merge(*streams, key=lambda r: r[:3]):
+            if self.dedup and not self.seen[rec[1]].add(rec[2]):
+                self.duplicates[rec[1]] += 1
+                continue
+            self.merged += 1
+            yield rec
+
+    def frames(self, batch_size=BATCH_SIZE):
+        '''Merged records as dataframes of batch_size records - blob, common fields, imsid and file'''
+        batch = []
+        for rec in self.records():
+            batch.append(rec)
+            if len(batch) >= batch_size:
+                yield merged_frame(batch)
+                batch = []
+        if batch: yield merged_frame(batch)
+
+    def write(self, dsn):
+        '''Writes merged records into DELIMETER separated log file, returns record count'''
+        count = 0
+        with open(dsn, 'wb') as f:
+            for rec in self.records():
+                if count > 0: f.write(DELIMETER)
+                f.write(rec[4])
+                count += 1
+        return count
+
+    def gaps(self):
+        '''Dataframe of missing sequence ranges per IMS id (from the merged records)'''
+        rows = [(imsid, s, e, e - s + 1) for imsid, rs in sorted(self.seen.items()) for s, e in rs.gaps()]
+        return pd.DataFrame(rows, columns=['imsid', 'seq_from', 'seq_to', 'missing'])
+
+    def report(self):
+        '''Per IMS id summary - records, duplicates dropped, sequence range and gaps'''
+        rows = []
+        for imsid, rs in sorted(self.seen.items()):
+            gaps = rs.gaps()
+            rows.append({'imsid': imsid, 'records': len(rs), 'duplicates': self.duplicates[imsid],
+                         'seq_min': rs.starts[0], 'seq_max': rs.ends[-1], 'gaps': len(gaps),
+                         'missing': sum(e - s + 1 for s, e in gaps)})
+        return pd.DataFrame(rows, columns=['imsid', 'records', 'duplicates', 'seq_min', 'seq_max', 'gaps', 'missing'])
+
+
+def merged_frame(batch):
+    df = logspecs.records_frame([r[4] for r in batch])
+    df['imsid'] = [r[1] for r in batch]
+    df['file'] = [r[3] for r in batch]
+    return df
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Merges log files into one timeline without duplicate records.')
+    parser.add_argument('files', nargs='+', help='log files to merge')
+    parser.add_argument('--output', required=True, help='merged log file')
+    parser.add_argument('--keep-duplicates', action='store_true', help='do not drop duplicate records')
+    args = parser.parse_args(argv)
+    merger = LogMerger(args.files, dedup=not args.keep_duplicates)
+    print('IMS ids: ' + ', '.join('{} {}'.format(os.path.basename(f), i) for f, i in merger.imsids.items()))
+    print('{} records written to {}'.format(merger.write(args.output), args.output))
+    print(merger.report().to_string(index=False))
+    gaps = merger.gaps()
+    if len(gaps): print(gaps.to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
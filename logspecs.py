@@ -10,8 +10,16 @@ It also contains descriptions of some log type records.
 '''
 
 import numpy as np
+import pandas as pd
 from enum import Flag, IntFlag
-import datetime
+import datetime, time, itertools
+import metrics
+
+'''TOD clock value of 1970-01-01 in microseconds since 1900'''
+EPOCH70_MICROS = 0x7D91048BCA000
+
+'''Hex strings of all byte values - categories of type and subtype columns'''
+HEX_BYTES = ['{:02x}'.format(v) for v in range(256)]
 
 def tod2datetime(tod):
     '''Converts mainframe 64bits TOD time to datetime'''
@@ -28,35 +36,215 @@ def set_flag(flag, value):
     except ValueError: return np.nan
 
 
+def tod2datetime64(tod):
+    '''Vectorized tod2datetime - converts array of 64bits TOD values to datetime64[us].
+    Zero and other pre 1970 clocks become NaT.'''
+    micros = (np.asarray(tod, dtype=np.uint64) >> np.uint64(12)).astype(np.int64) - EPOCH70_MICROS
+    return np.where(micros > 0, micros, np.iinfo(np.int64).min).view('datetime64[us]')
+
+
 def extract_common_fields(df):
     '''Operates over dataframe with log records - from the binary blob
     it takes fields common for all types of IMS logs in the dataframe.
     Result is stored in the dataframe.'''
-    df['type'] = df['blob'].apply(lambda x: x[0:1].hex())
-    df['subtype'] = df['blob'].apply(lambda x: x[1:2].hex())
-    df['sequence'] = df['blob'].apply(lambda x: int(x[-8:].hex(), 16))
-    df['tod'] = df['blob'].apply(lambda x: int(x[-16:-8].hex(), 16))
-    df['datetime'] = df['blob'].apply(lambda x: tod2datetime(x[-16:-8].hex()))
+    for key, val in common_fields(df['blob']).items():
+        df[key] = val
+
+
+def common_fields(blobs):
+    '''Returns dict with common fields (type, subtype, sequence, tod, datetime)
+    of sequence of records. First two and last sixteen bytes of all records are
+    gathered in one pass and decoded as arrays.'''
+    with metrics.stage('common_fields', records=len(blobs)):
+        lens = np.fromiter(map(len, blobs), dtype=np.int64, count=len(blobs))
+        buf = b''.join(bytes(x[:2]).ljust(2, b'\x00') + bytes(x[-16:]).rjust(16, b'\x00') for x in blobs)
+        mat = np.frombuffer(buf, dtype=np.uint8).reshape(len(lens), 18)
+        return decode_common_fields(mat[:, :2], mat[:, 2:], lens)
+
+
+def common_fields_from_buffer(buf, offsets, lengths):
+    '''The same as common_fields() for records given by offsets and lengths
+    into one buffer (e.g. mapped log file)'''
+    with metrics.stage('common_fields', records=len(offsets)):
+        data = np.frombuffer(buf, dtype=np.uint8)
+        offsets = np.asarray(offsets, dtype=np.int64)
+        lengths = np.asarray(lengths, dtype=np.int64)
+        pos = np.arange(2)
+        head = np.where(pos < lengths[:, None], data[np.where(pos < lengths[:, None], offsets[:, None] + pos, 0)], 0)
+        pos = np.arange(16)
+        valid = pos >= 16 - lengths[:, None]          # short records are right aligned
+        tail = np.where(valid, data[np.where(valid, (offsets + lengths - 16)[:, None] + pos, 0)], 0)
+        return decode_common_fields(head, tail, lengths)
+
+
+def records_frame(blobs):
+    '''Dataframe with blob column and common fields of sequence of records'''
+    df = pd.DataFrame({'blob': blobs})
+    for key, val in common_fields(blobs).items():
+        df[key] = val
+    return df
+
+
+def records_frame_from_buffer(buf, offsets, lengths):
+    '''The same as records_frame() for records given by offsets and lengths
+    into one buffer - blobs are copied out of it'''
+    with metrics.stage('blobs', records=len(offsets)):
+        blobs = [bytes(buf[o:o + l]) for o, l in zip(np.asarray(offsets).tolist(), np.asarray(lengths).tolist())]
+        df = pd.DataFrame({'blob': blobs})
+    for key, val in common_fields_from_buffer(buf, offsets, lengths).items():
+        df[key] = val
+    return df
+
+
+def decode_common_fields(head, tail, lens):
+    '''Turns first two bytes (type, subtype) and last sixteen bytes (tod, sequence)
+    of records into columns. Type and subtype are categorical with hex string categories
+    so comparisons like df['type'] == '50' keep working.'''
+    tail = np.ascontiguousarray(tail, dtype=np.uint8)
+    head = np.asarray(head, dtype=np.uint8)
+    tod = tail[:, :8].copy().view('>u8').ravel().astype(np.uint64)
+    tod[lens < 16] = 0                            # record too short to carry a clock
+    seq = tail[:, 8:].copy().view('>u8').ravel().astype(np.uint64)
+    return {'type':     pd.Categorical.from_codes(head[:, 0].astype(np.int16), categories=HEX_BYTES),
+            'subtype':  pd.Categorical.from_codes(head[:, 1].astype(np.int16), categories=HEX_BYTES),
+            'sequence': seq,
+            'tod':      tod,
+            'datetime': tod2datetime64(tod)}
+
     
 def add_descriptions(df):
     '''Adds log type descrion to records'''
-    df['desc'] = df['type'].apply(lambda x: log_desc[x.upper()])
+    types = df['type'].astype(str)   # type can be categorical, describe only types really present
+    df['desc'] = types.map({t: log_desc[t.upper()] for t in types.unique()})
 
 
 def extract_typespecific_fields(log_specifics, df):
     '''Operates over dataframe with log records - from the binary blob
     it takes specific fields defined by log_specific structure.
     Result is stored in the dataframe.'''
-    for key,it in log_specifics.items():                        
-        if it['type'] == 'txt': val = df['blob'].apply(lambda x: 
-                                x[it['off_start']:it['off_end']].decode('cp500'))
-        if it['type'] == 'int': val = df['blob'].apply(lambda x: 
-                                int.from_bytes(x[it['off_start']:it['off_end']], byteorder='big'))
-        if it['type'] == 'flg': val = df['blob'].apply(lambda x: 
-                                set_flag(it['flags'], int.from_bytes(x[it['off_start']:it['off_start']+1], byteorder='big')))
+    for key, val in compile_fields(log_specifics).extract(df['blob']).items():
         df[key] = val
 
 
+'''EBCDIC (cp500) to latin-1 translation table. cp500 maps every byte to exactly
+one latin-1 character so whole byte matrices can be translated by indexing.'''
+EBCDIC_TO_LATIN1 = np.frombuffer(bytes(range(256)).decode('cp500').encode('latin-1'), dtype=np.uint8)
+
+'''Rows gathered at once when fields are extracted from a mapped log file'''
+GATHER_CHUNK = 1 << 16
+
+
+def gather_fields(blobs, off_start, off_end):
+    '''Copies bytes off_start:off_end of every record into 2-D uint8 matrix in one pass.
+    Short records are zero padded. Returns the matrix and array of record lengths.
+    Rows are joined GATHER_CHUNK at a time, so temporary slices don't outgrow the matrix.'''
+    span = off_end - off_start
+    lens = np.fromiter(map(len, blobs), dtype=np.int64, count=len(blobs))
+    mat = np.empty((len(lens), span), dtype=np.uint8)
+    it = iter(blobs)
+    for i in range(0, len(lens), GATHER_CHUNK):
+        n = min(GATHER_CHUNK, len(lens) - i)
+        buf = b''.join(bytes(x[off_start:off_end]).ljust(span, b'\x00') for x in itertools.islice(it, n))
+        mat[i:i + n] = np.frombuffer(buf, dtype=np.uint8).reshape(n, span)
+    return mat, lens
+
+
+def gather_fields_from_buffer(buf, offsets, lengths, off_start, off_end):
+    '''The same as gather_fields() for records given by offsets and lengths
+    into one buffer (e.g. mapped log file), no per record python work is done.'''
+    data = np.frombuffer(buf, dtype=np.uint8)
+    cols = np.arange(off_start, off_end, dtype=np.int64)
+    valid = cols[None, :] < lengths[:, None]
+    idx = np.where(valid, offsets[:, None] + cols[None, :], 0)
+    mat = data[idx]
+    mat[~valid] = 0
+    return mat, np.asarray(lengths, dtype=np.int64)
+
+
+class CompiledFields:
+    '''Vectorized extractor built from log_items/deadlock_map like structure.
+    All fields are taken from one byte matrix gathered for all records at once,
+    integers are read as big endian NumPy views and texts are translated from
+    EBCDIC by table lookup. name (e.g. record type) is the key of its metrics.'''
+    def __init__(self, log_specifics, name=None):
+        self.name = name
+        self.fields = []
+        for key, it in log_specifics.items():
+            start = it['off_start']
+            end = start + 1 if it['type'] == 'flg' else it['off_end']
+            self.fields.append((key, it['type'], start, end, it.get('flags')))
+        self.off_start = min((f[2] for f in self.fields), default=0)
+        self.off_end = max((f[3] for f in self.fields), default=0)
+        self.flag_tables = {key: flag_table(flags) for key, tp, _, _, flags in self.fields if tp == 'flg'}
+
+    def extract(self, blobs):
+        '''Returns dict field name -> column values for sequence of records'''
+        with metrics.stage('extract', self.name, records=len(blobs)):
+            mat, lens = gather_fields(blobs, self.off_start, self.off_end)
+            return self.decode(mat, lens)
+
+    def extract_from_buffer(self, buf, offsets, lengths, chunk=GATHER_CHUNK):
+        '''Returns dict field name -> column values for records given by offsets/lengths into buf'''
+        with metrics.stage('extract', self.name, records=len(offsets)):
+            parts = [self.decode(*gather_fields_from_buffer(buf, offsets[i:i + chunk], lengths[i:i + chunk],
+                                                             self.off_start, self.off_end))
+                     for i in range(0, len(offsets), chunk)]
+            if len(parts) == 0: return self.decode(np.zeros((0, self.off_end - self.off_start), dtype=np.uint8),
+                                                   np.empty(0, dtype=np.int64))
+            return {key: ([v for p in parts for v in p[key]] if tp == 'txt' else np.concatenate([p[key] for p in parts]))
+                    for key, tp, _, _, _ in self.fields}
+
+    def decode(self, mat, lens):
+        '''Turns gathered byte matrix into columns, decoding time of every field
+        goes to extract_field metrics'''
+        cols = {}
+        for key, tp, start, end, flags in self.fields:
+            t = time.perf_counter()
+            sub = mat[:, start - self.off_start:end - self.off_start]
+            avail = np.clip(lens - start, 0, end - start)   # bytes really present in short records
+            if tp == 'txt': cols[key] = decode_txt(sub, avail)
+            if tp == 'int': cols[key] = decode_int(sub, avail)
+            if tp == 'flg': cols[key] = self.flag_tables[key][sub[:, 0]]
+            metrics.count('extract_field', key if self.name is None else self.name + '.' + key,
+                          records=len(lens), wall=time.perf_counter() - t)
+        return cols
+
+
+def compile_fields(log_specifics, name=None):
+    '''Compiles log_specifics structure into CompiledFields extractor'''
+    return CompiledFields(log_specifics, name)
+
+
+def flag_table(flags):
+    '''Lookup table byte value -> flag (or nan) for all 256 values'''
+    table = np.empty(256, dtype=object)
+    for v in range(256): table[v] = set_flag(flags, v)
+    return table
+
+
+def decode_txt(sub, avail):
+    '''Translates EBCDIC byte matrix into list of strings'''
+    width = sub.shape[1]
+    txt = EBCDIC_TO_LATIN1[sub].tobytes().decode('latin-1')
+    if np.all(avail == width): return [txt[i:i + width] for i in range(0, len(txt), width)]
+    return [txt[i * width:i * width + a] for i, a in enumerate(avail.tolist())]
+
+
+def decode_int(sub, avail):
+    '''Reads big endian unsigned integers from byte matrix. Values in short
+    records are made of the available bytes only, as int.from_bytes would do.'''
+    n, width = sub.shape
+    if width > 8: return np.array([int.from_bytes(bytes(r[:a]), byteorder='big')
+                                   for r, a in zip(sub, avail)], dtype=object)
+    padded = np.zeros((n, 8), dtype=np.uint8)
+    padded[:, 8 - width:] = sub
+    val = padded.view('>u8').ravel().astype(np.uint64)
+    if not np.all(avail == width):
+        shift = (8 * (width - avail)).astype(np.uint64)
+        val = np.where(avail > 0, val >> np.minimum(shift, 63), 0).astype(np.uint64)
+    if width < 8: return val.astype(np.int64)
+    return val
+
 
 '''Specific log records description follows'''
 class log50DborgFlag(Flag):
@@ -0,0 +1,371 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Partitioned on-disk store of log records. Records are kept in Parquet files
+laid out as  <store>/type=50/subtype=ff/day=2018-08-06/<log file>.parquet
+so reading x'42' records of one day touches only that directory and no x'50'
+blob is ever deserialized. Filters on IMS id and time are pushed down to
+Parquet row groups and only requested columns are read.
+
+    store = LogStore('store/')
+    log42 = store.read(types='42', start='2018-08-06', end='2018-08-07')
+
+Every write also stores per second record counts by type, subtype and IMS id
+of the log file in <store>/_rollups/, histograms come from them without
+reading any record:
+
+    store.counts('1h', by='type', types='42')
+
+Every write of a log file is a new generation of its files, named
+<log file>~<generation>.parquet. Manifest entry of the log file says which
+generation is current and readers skip all other files, so a changed log file
+is replaced as a whole when its entry is switched - never partly.
+'''
+
+import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import os, json, re, time, threading
+import logspecs, metrics
+
+STORE_PATH = 'store/'
+
+'''Partition columns are part of directory names, not of the Parquet files'''
+PARTITIONING = ds.partitioning(pa.schema([('type', pa.string()),
+                                          ('subtype', pa.string()),
+                                          ('day', pa.string())]), flavor='hive')
+
+'''Columns stored in Parquet files'''
+RECORD_SCHEMA = pa.schema([('blob', pa.binary()),
+                           ('sequence', pa.uint64()),
+                           ('tod', pa.uint64()),
+                           ('datetime', pa.timestamp('us')),
+                           ('imsid', pa.string())])
+
+'''Partition file name - log file, generation (none in stores written before
+generations existed) and batch number of streamed log file'''
+FILE_NAME = re.compile(r'^(?P<source>.+?)(~(?P<generation>[0-9a-f]+))?(@(?P<part>\d+))?\.parquet$')
+
+'''Writers in several threads (ftpdown streams) share one manifest'''
+MANIFEST_LOCK = threading.Lock()
+
+'''Manifest of log files already in the store. Leading underscore keeps
+it out of the Parquet dataset.'''
+MANIFEST_NAME = '_manifest.json'
+
+'''Record count rollups - one file per log file (or streamed batch) in this
+directory, leading underscore keeps them out of the records dataset'''
+ROLLUP_DIR = '_rollups'
+ROLLUP_FREQ = '1s'
+ROLLUP_KEYS = ['type', 'subtype', 'imsid']
+ROLLUP_SCHEMA = pa.schema([('bucket', pa.timestamp('us')),
+                           ('type', pa.string()),
+                           ('subtype', pa.string()),
+                           ('imsid', pa.string()),
+                           ('count', pa.int64())])
+
+'''Maximum records in one dataframe of LogStore.batches()'''
+BATCH_ROWS = 100000
+
+'''Day partition of records without valid TOD clock'''
+NODAY = 'none'
+
+'''Fields extracting IMS id, only for log types which carry it'''
+IMSID_FIELDS = {t: logspecs.compile_fields({'imsid': it['imsid']}, t)
+                for t, it in logspecs.log_items.items() if 'imsid' in it}
+
+
+def add_imsid(df):
+    '''Adds imsid column for log types which have it (see logspecs.log_items), None elsewhere'''
+    imsid = np.full(len(df), None, dtype=object)
+    types = np.asarray(df['type'].astype(str))
+    for t, fields in IMSID_FIELDS.items():
+        sel = np.flatnonzero(types == t)
+        if len(sel) == 0: continue
+        imsid[sel] = fields.extract(df['blob'].iloc[sel].tolist())['imsid']
+    df['imsid'] = imsid
+
+
+def rollup(df, freq=ROLLUP_FREQ):
+    '''Record counts of df (type, subtype, imsid and datetime columns) per freq
+    time bucket and ROLLUP_KEYS. Records without clock get null bucket.'''
+    keys = pd.DataFrame({'bucket': pd.Series(df['datetime']).dt.floor(freq).values,
+                         'type': np.asarray(df['type'].astype(str), dtype=object),
+                         'subtype': np.asarray(df['subtype'].astype(str), dtype=object),
+                         'imsid': np.asarray(df['imsid'], dtype=object)})
+    return keys.groupby(['bucket'] + ROLLUP_KEYS, dropna=False, sort=True).size().rename('count').reset_index()
+
+
+def write_table(table, path):
+    '''Writes Parquet file through temporary dot file, readers never see half written file'''
+    tmp = os.path.join(os.path.dirname(path), '.' + os.path.basename(path) + '.tmp')   # dot files are ignored by readers
+    pq.write_table(table, tmp)
+    os.replace(tmp, path)
+
+
+def new_generation():
+    return '{:x}'.format(time.time_ns())
+
+
+def source_file_name(source, part=None, generation=None):
+    '''Partition file name of log file records, part is batch number of streamed log file'''
+    name = os.path.basename(source)
+    if generation is not None: name += '~' + generation
+    if part is None: return name + '.parquet'
+    return '{}@{:05d}.parquet'.format(name, part)
+
+
+def parse_file_name(fname):
+    '''(log file, generation, part) of partition file name, None for other files'''
+    m = FILE_NAME.match(fname)
+    if m is None: return None
+    return m.group('source'), m.group('generation'), m.group('part')
+
+
+def current(manifest, fname):
+    '''True for files of the generation in manifest entry of their log file'''
+    parsed = parse_file_name(fname)
+    return parsed is not None and manifest.get(parsed[0], {}).get('generation') == parsed[1]
+
+
+def as_list(val):
+    '''Filter value can be one value or list of them'''
+    if val is None: return None
+    if isinstance(val, (str, bytes)): return [val]
+    return list(val)
+
+
+def key_filter(types=None, subtypes=None, imsids=None):
+    '''Dataset filter expression on type, subtype and IMS id, None when no filter is given'''
+    filt = None
+    for col, val in (('type', types), ('subtype', subtypes), ('imsid', imsids)):
+        if val is None: continue
+        expr = ds.field(col).isin(as_list(val))
+        filt = expr if filt is None else filt & expr
+    return filt
+
+
+class LogStore:
+    '''Log records partitioned by type, subtype and day'''
+    def __init__(self, path=STORE_PATH):
+        self.path = path
+
+    def partition_dir(self, tp, subtype, day):
+        return os.path.join(self.path, 'type='+tp, 'subtype='+subtype, 'day='+day)
+
+    def write(self, df, source, part=None, entry=None, generation=None):
+        '''Stores records of one log file (dataframe with common fields) as new
+        generation of its files - every partition gets <source>~<generation>.parquet
+        file and the record count rollup one more. When all are written the manifest
+        entry of the log file (entry when given) is switched to the new generation
+        and files of the previous version are removed, so readers see either old
+        or new version of the log file. Failed write removes its files.
+        With part (batch number of streamed log file) the records go to
+        <source>~<generation>@<part>.parquet files of generation given and nothing
+        is switched or removed - batches are not read until compact() and publish().
+        Returns number of written partition files.'''
+        with metrics.stage('store_write', records=len(df)):
+            df = df.copy()
+            if 'imsid' not in df: add_imsid(df)
+            df['type'] = df['type'].astype(str)
+            df['subtype'] = df['subtype'].astype(str)
+            df['day'] = pd.Series(df['datetime']).dt.strftime('%Y-%m-%d').fillna(NODAY).values
+            if part is None: generation = new_generation()
+            fname = source_file_name(source, part, generation)
+            written = []
+            try:
+                for (tp, subtype, day), records in df.groupby(['type', 'subtype', 'day'], sort=False):
+                    pdir = self.partition_dir(tp, subtype, day)
+                    os.makedirs(pdir, exist_ok=True)
+                    with metrics.stage('store_partition', tp, records=len(records)):
+                        table = pa.Table.from_pandas(records[RECORD_SCHEMA.names], schema=RECORD_SCHEMA, preserve_index=False)
+                        write_table(table, os.path.join(pdir, fname))
+                    written.append(os.path.join(pdir, fname))
+                written.append(self.write_rollup(rollup(df), fname))
+            except BaseException:
+                for path in written: os.remove(path)
+                raise
+            if part is None: self.publish(source, generation, entry)
+            return len(written) - 1
+
+    def publish(self, source, generation, entry=None):
+        '''Makes generation the current one of the log file - saves it in manifest
+        entry of the log file (entry, or the old one when entry is None). Files of
+        other generations are removed then.'''
+        name = os.path.basename(source)
+        with MANIFEST_LOCK:
+            manifest = self.read_manifest()
+            manifest[name] = dict(entry if entry is not None else manifest.get(name, {}), generation=generation)
+            self.write_manifest(manifest)
+        self.remove(source, keep=generation)
+
+    def update_manifest(self, source, entry):
+        '''Saves manifest entry of log file, generation of its files is kept'''
+        name = os.path.basename(source)
+        with MANIFEST_LOCK:
+            manifest = self.read_manifest()
+            entry = dict(entry)
+            if 'generation' in manifest.get(name, {}): entry['generation'] = manifest[name]['generation']
+            manifest[name] = entry
+            self.write_manifest(manifest)
+
+    def write_rollup(self, counts, fname):
+        '''Saves rollup (see rollup()) under partition file name fname, returns its path'''
+        rdir = os.path.join(self.path, ROLLUP_DIR)
+        os.makedirs(rdir, exist_ok=True)
+        path = os.path.join(rdir, fname)
+        write_table(pa.Table.from_pandas(counts[ROLLUP_SCHEMA.names], schema=ROLLUP_SCHEMA, preserve_index=False), path)
+        return path
+
+    def rebuild_rollups(self):
+        '''Recomputes rollups of all records in the store, e.g. for store written
+        before rollups existed. Only datetime and imsid columns are read.'''
+        parts = {}
+        for d, _, files in os.walk(self.path):
+            if os.path.relpath(d, self.path).split(os.sep)[0] == ROLLUP_DIR: continue
+            names = dict(p.split('=', 1) for p in os.path.relpath(d, self.path).split(os.sep) if '=' in p)
+            for f in files:
+                if f.startswith(('.', '_')) or not f.endswith('.parquet'): continue
+                df = pq.read_table(os.path.join(d, f), columns=['datetime', 'imsid']).to_pandas()
+                df['type'], df['subtype'] = names['type'], names['subtype']
+                parts.setdefault(f, []).append(df)
+        for fname, frames in parts.items():
+            self.write_rollup(rollup(pd.concat(frames, ignore_index=True)), fname)
+        return len(parts)
+
+    def source_files(self, source):
+        '''Partition files holding records of given log file, streamed batches
+        and all generations included'''
+        name = os.path.basename(source)
+        if not os.path.isdir(self.path): return []
+        def of_source(f):
+            parsed = parse_file_name(f)
+            return parsed is not None and parsed[0] == name
+        return [os.path.join(d, f) for d, _, files in os.walk(self.path) for f in files if of_source(f)]
+
+    def current_files(self, rollups=False):
+        '''Record (or rollup) files of current generations, see current()'''
+        if not os.path.isdir(self.path): return []
+        manifest = self.read_manifest()
+        if rollups:
+            rdir = os.path.join(self.path, ROLLUP_DIR)
+            if not os.path.isdir(rdir): return []
+            return sorted(os.path.join(rdir, f) for f in os.listdir(rdir) if current(manifest, f))
+        files = []
+        for d, dirs, fnames in os.walk(self.path):
+            if os.path.relpath(d, self.path) == '.': dirs[:] = [x for x in dirs if not x.startswith(('.', '_'))]
+            files.extend(os.path.join(d, f) for f in fnames if current(manifest, f))
+        return sorted(files)
+
+    def compact(self, source, generation=None):
+        '''Joins batch files <source>~<generation>@<part>.parquet of streamed log file
+        into one <source>~<generation>.parquet per partition, every batch becomes one
+        row group, so the store keeps one file per partition and log file whatever
+        the log size is. Batch files are copied one at a time, memory of one batch
+        is needed. Batch rollups are summed into one rollup file. Generation is not
+        published (see publish()), so readers see no batch twice.
+        Returns number of compacted partitions.'''
+        fname = source_file_name(source, generation=generation)
+        batches = {}
+        for path in self.source_files(source):
+            _, gen, part = parse_file_name(os.path.basename(path))
+            if gen == generation and part is not None:
+                batches.setdefault(os.path.dirname(path), []).append((int(part), path))
+        rdir = os.path.normpath(os.path.join(self.path, ROLLUP_DIR))
+        compacted = 0
+        for pdir, paths in batches.items():
+            paths = [p for _, p in sorted(paths)]
+            if os.path.normpath(pdir) == rdir:
+                counts = pd.concat([pq.read_table(p, schema=ROLLUP_SCHEMA).to_pandas() for p in paths])
+                counts = counts.groupby(['bucket'] + ROLLUP_KEYS, dropna=False, sort=True)['count'].sum().reset_index()
+                self.write_rollup(counts, fname)
+            else:
+                tmp = os.path.join(pdir, '.' + fname + '.tmp')
+                with pq.ParquetWriter(tmp, RECORD_SCHEMA) as writer:
+                    for path in paths: writer.write_table(pq.read_table(path, schema=RECORD_SCHEMA))
+                os.replace(tmp, os.path.join(pdir, fname))
+                compacted += 1
+            for path in paths: os.remove(path)
+        return compacted
+
+    def discard(self, source, generation):
+        '''Removes files of not published generation of log file, e.g. of failed stream'''
+        for path in self.source_files(source):
+            if parse_file_name(os.path.basename(path))[1] == generation: os.remove(path)
+
+    def remove(self, source, keep=None):
+        '''Removes all records of given log file from the store, files of generation keep excepted'''
+        for path in self.source_files(source):
+            if keep is None or parse_file_name(os.path.basename(path))[1] != keep: os.remove(path)
+
+    def read_manifest(self):
+        '''Dict log file name -> its manifest entry (size, mtime, sha1, records, sequence range)'''
+        try:
+            with open(os.path.join(self.path, MANIFEST_NAME), 'r') as f: return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def write_manifest(self, manifest):
+        os.makedirs(self.path, exist_ok=True)
+        tmp = os.path.join(self.path, MANIFEST_NAME + '.tmp')
+        with open(tmp, 'w') as f: json.dump(manifest, f, indent=1, sort_keys=True)
+        os.replace(tmp, os.path.join(self.path, MANIFEST_NAME))
+
+    def dataset(self):
+        '''pyarrow dataset over current files of the whole store, None for empty store'''
+        if not os.path.isdir(self.path): return None
+        schema = pa.unify_schemas([RECORD_SCHEMA, PARTITIONING.schema])
+        return ds.dataset(self.current_files(), format='parquet', partitioning=PARTITIONING,
+                          partition_base_dir=self.path, schema=schema)
+
+    def counts(self, freq='1h', by='type', types=None, subtypes=None, imsids=None, start=None, end=None):
+        '''Record counts per freq time bucket (any pandas frequency not finer than
+        ROLLUP_FREQ) and by columns (some of type, subtype, imsid) from rollups.
+        Filters are the same as in read(). Returns dataframe bucket, by..., count.'''
+        by = as_list(by) or []
+        files = self.current_files(rollups=True)
+        if len(files) == 0: return pd.DataFrame(data=[], columns=['bucket'] + by + ['count'])
+        dataset = ds.dataset(files, format='parquet', schema=ROLLUP_SCHEMA)
+        filt = key_filter(types, subtypes, imsids)
+        def both(f, g): return g if f is None else f & g
+        if start is not None: filt = both(filt, ds.field('bucket') >= pa.scalar(np.datetime64(pd.Timestamp(start), 'us')))
+        if end is not None: filt = both(filt, ds.field('bucket') < pa.scalar(np.datetime64(pd.Timestamp(end), 'us')))
+        df = dataset.to_table(columns=['bucket'] + by + ['count'], filter=filt).to_pandas()
+        df['bucket'] = df['bucket'].dt.floor(freq)
+        return df.groupby(['bucket'] + by, dropna=False, sort=True)['count'].sum().reset_index()
+
+    def record_filter(self, types=None, subtypes=None, imsids=None, start=None, end=None):
+        '''Dataset filter of read() arguments, day partitions are pruned by time range'''
+        filt = key_filter(types, subtypes, imsids)
+        def both(f, g): return g if f is None else f & g
+        if start is not None:
+            start = pd.Timestamp(start)
+            filt = both(filt, (ds.field('day') >= start.strftime('%Y-%m-%d')) & (ds.field('day') != NODAY))
+            filt = both(filt, ds.field('datetime') >= pa.scalar(np.datetime64(start, 'us')))
+        if end is not None:
+            end = pd.Timestamp(end)
+            filt = both(filt, ds.field('day') <= end.strftime('%Y-%m-%d'))
+            filt = both(filt, ds.field('datetime') < pa.scalar(np.datetime64(end, 'us')))
+        return filt
+
+    def read(self, types=None, subtypes=None, imsids=None, start=None, end=None, columns=None):
+        '''Reads records matching all given filters into dataframe.
+        types, subtypes, imsids - value or list of values ('50', 'ff', 'IMS1')
+        start, end              - time range [start, end), anything pd.Timestamp accepts
+        columns                 - columns to read, all by default'''
+        dataset = self.dataset()
+        if dataset is None: return pd.DataFrame(data=[], columns=columns or [])
+        filt = self.record_filter(types, subtypes, imsids, start, end)
+        return dataset.to_table(columns=columns, filter=filt).to_pandas()
+
+    def batches(self, types=None, subtypes=None, imsids=None, start=None, end=None, columns=None,
+                batch_size=BATCH_ROWS):
+        '''Generator of dataframes with at most batch_size records matching filters
+        (the same as in read()), the whole result is never held in memory'''
+        dataset = self.dataset()
+        if dataset is None: return
+        filt = self.record_filter(types, subtypes, imsids, start, end)
+        for batch in dataset.to_batches(columns=columns, filter=filt, batch_size=batch_size):
+            if batch.num_rows > 0: yield batch.to_pandas()
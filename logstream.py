@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Streaming ingest - log records go from FTP download straight into LogStore.
+LogDownloader/RDWDownloader write into ChunkQueue instead of a file, parser
+thread takes the chunks from it, split_stream() cuts them into batches of
+records and ingest_stream() appends every batch to the store as soon as it is
+complete. Memory use is bounded by the batch size whatever the log size is.
+Batches are stored as new generation of the log file which is not read until
+the stream is complete - then the batch files are compacted into one file per
+partition (LogStore.compact(), big logs don't leave thousands of small files)
+and the generation is published. Until then readers see the previous version
+of the log file, failed stream leaves no records behind.
+Raw copy of the log file is optional.
+
+    python ftpdown.py   with STREAM_STORE = 'store/'
+'''
+
+import queue, hashlib
+import logspecs, logstore
+from imslog import find_delimeters, DELIMETER
+
+'''Records per batch appended to the store'''
+BATCH_SIZE = 100000
+
+'''Downloaded chunks waiting for the parser, download waits when it is full'''
+QUEUE_CHUNKS = 256
+
+
+class ChunkQueue:
+    '''File-like sink for downloaders. Written chunks are handed over to the consumer
+    iterating over it through bounded queue, optional raw file gets a copy of them.'''
+    def __init__(self, raw=None, maxsize=QUEUE_CHUNKS):
+        self.queue = queue.Queue(maxsize)
+        self.raw = raw                # opened file for raw copy of the stream or None
+        self.abandoned = False        # consumer stopped reading
+
+    def put(self, item):
+        while True:
+            if self.abandoned: raise OSError('stream consumer stopped')
+            try:
+                self.queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def write(self, data):
+        if len(data) == 0: return
+        data = bytes(data)
+        if self.raw is not None: self.raw.write(data)
+        self.put(data)
+
+    def close(self, error=None):
+        '''End of stream, error (exception of the producer) is raised in the consumer'''
+        self.put(error)
+
+    def abandon(self):
+        '''Consumer gives up, producer gets OSError on next write'''
+        self.abandoned = True
+
+    def __iter__(self):
+        while True:
+            item = self.queue.get()
+            if item is None: return
+            if isinstance(item, BaseException): raise item
+            yield item
+
+
+def split_stream(chunks, batch_size=BATCH_SIZE):
+    '''Generator of record batches (lists of bytes) from DELIMETER separated
+    stream given as iterable of chunks. Unfinished record is searched again
+    together with the next chunk so delimeter split between chunks is found.
+    Empty records are left out as in imslog.split_records().'''
+    pending = b''
+    batch = []
+    for chunk in chunks:
+        buf = pending + chunk if pending else chunk
+        delims = find_delimeters(buf).tolist()
+        start = 0
+        for end in delims:
+            if end > start: batch.append(buf[start:end])
+            start = end + len(DELIMETER)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        pending = buf[start:]
+    if pending: batch.append(pending)
+    if batch: yield batch
+
+
+def ingest_stream(chunks, store, source, batch_size=BATCH_SIZE):
+    '''Parses stream of log file chunks and appends record batches to the store
+    as new generation of the log file. When the stream is complete the batch files
+    are compacted and the generation replaces records stored for source before,
+    with the manifest entry of the source, which is returned. The entry has no
+    mtime, so imslog.py --store checks a raw copy of the log by content hash.
+    Batches of failed stream are removed.'''
+    generation = logstore.new_generation()
+    sha1 = hashlib.sha1()
+    entry = {'size': 0, 'mtime_ns': None, 'sha1': None, 'records': 0, 'seq_min': None, 'seq_max': None}
+    def hashed(chunks):
+        for chunk in chunks:
+            sha1.update(chunk)
+            entry['size'] += len(chunk)
+            yield chunk
+    try:
+        for part, batch in enumerate(split_stream(hashed(chunks), batch_size)):
+            df = logspecs.records_frame(batch)
+            store.write(df, source, part=part, generation=generation)
+            entry['records'] += len(df)
+            seq_min, seq_max = int(df['sequence'].min()), int(df['sequence'].max())
+            entry['seq_min'] = seq_min if entry['seq_min'] is None else min(entry['seq_min'], seq_min)
+            entry['seq_max'] = seq_max if entry['seq_max'] is None else max(entry['seq_max'], seq_max)
+        store.compact(source, generation)
+    except BaseException:
+        store.discard(source, generation)
+        raise
+    entry['sha1'] = sha1.hexdigest()
+    store.publish(source, generation, entry)
+    return entry
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Run metrics of download, ingest and extraction stages. Code is instrumented by
+
+    with metrics.stage('split', nbytes=size) as st:
+        ...
+        st.records = len(offsets)
+
+and by metrics.count() for values measured elsewhere. Every (stage, key) entry
+keeps calls, wall and CPU time, bytes in, records out and RSS taken at the
+start and the end of every call - rss is the largest RSS at a stage end and
+rss_growth the largest growth within one call. Short peaks inside a stage are
+not seen, benchmark.PeakRSS samples them. Key is record type, field or
+dataset, None for stage total. A stage costs about 0.1 ms (two RSS reads),
+stages wrap files and batches, not records, so they are always on. cProfile
+and tracemalloc are switched on by enable() only. Pool workers send their
+entries back with results (see collect() and merge()), profiles of workers are not kept.
+At the end of run report() writes JSON or CSV:
+
+    python imslog.py --metrics nightly.json --profile
+    metrics.frame()                 # the same as dataframe
+'''
+
+import numpy as np
+import pandas as pd
+import os, sys, time, json, csv, threading, contextlib, cProfile, tracemalloc, psutil
+try:
+    import resource
+except ImportError:              # not on Windows, lifetime peak RSS of the run is reported as 0
+    resource = None
+
+'''Allocation sites listed in JSON report when tracemalloc is on'''
+TRACEMALLOC_TOP = 25
+
+COLUMNS = ['stage', 'key', 'calls', 'wall', 'cpu', 'bytes', 'records', 'rss', 'rss_growth', 'records_per_s', 'mb_per_s']
+
+
+class Stage:
+    '''Measurements of one stage and key'''
+    __slots__ = ('calls', 'wall', 'cpu', 'bytes', 'records', 'rss', 'rss_growth')
+
+    def __init__(self, calls=0, wall=0.0, cpu=0.0, nbytes=0, records=0, rss=0, rss_growth=0):
+        self.calls, self.wall, self.cpu = calls, wall, cpu
+        self.bytes, self.records = nbytes, records
+        self.rss, self.rss_growth = rss, rss_growth
+
+    def add(self, other):
+        self.calls += other.calls
+        self.wall += other.wall
+        self.cpu += other.cpu
+        self.bytes += other.bytes
+        self.records += other.records
+        self.rss = max(self.rss, other.rss)
+        self.rss_growth = max(self.rss_growth, other.rss_growth)
+
+    def row(self):
+        return {'calls': self.calls, 'wall': self.wall, 'cpu': self.cpu, 'bytes': int(self.bytes),
+                'records': int(self.records), 'rss': self.rss, 'rss_growth': self.rss_growth,
+                'records_per_s': self.records / self.wall if self.wall > 0 and self.records else None,
+                'mb_per_s': self.bytes / self.wall / 1e6 if self.wall > 0 and self.bytes else None}
+
+
+LOCK = threading.Lock()          # downloads update metrics from several threads
+STAGES = {}                      # (stage, key) -> Stage
+RUN = {'start': time.time(), 'profiler': None}
+
+
+def rss():
+    '''Current resident set size of this process in bytes'''
+    return psutil.Process().memory_info().rss     # new Process, pool workers are forked
+
+
+def peak_rss():
+    '''Lifetime peak resident set size of this process in bytes'''
+    if resource is None: return 0
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def add(name, key, st):
+    with LOCK:
+        if (name, key) not in STAGES: STAGES[(name, key)] = Stage()
+        STAGES[(name, key)].add(st)
+
+
+@contextlib.contextmanager
+def stage(name, key=None, nbytes=0, records=0):
+    '''Times the with block as one call of stage name (and key). Yields Stage,
+    its bytes and records can be set inside the block. CPU time is the one of
+    the calling thread.'''
+    st = Stage(1, nbytes=nbytes, records=records)
+    start_rss = rss()
+    wall, cpu = time.perf_counter(), time.thread_time()
+    try:
+        yield st
+    finally:
+        st.wall = time.perf_counter() - wall
+        st.cpu = time.thread_time() - cpu
+        st.rss = rss()
+        st.rss_growth = max(st.rss - start_rss, 0)
+        add(name, key, st)
+
+
+def count(name, key=None, records=0, nbytes=0, wall=0.0, cpu=0.0, calls=0):
+    '''Adds values measured by the caller'''
+    add(name, key, Stage(calls, wall, cpu, nbytes, records))
+
+
+def by_type(name, types, lengths=None):
+    '''Records (and bytes with lengths) per record type, types is e.g. type column'''
+    if len(types) == 0: return
+    values, inverse = np.unique(np.asarray(types).astype(str), return_inverse=True)
+    records = np.bincount(inverse)
+    nbytes = np.bincount(inverse, weights=lengths) if lengths is not None else np.zeros(len(values))
+    for tp, r, b in zip(values.tolist(), records.tolist(), nbytes.tolist()):
+        count(name, tp, records=r, nbytes=int(b))
+
+
+def reset():
+    with LOCK: STAGES.clear()
+    RUN['start'] = time.time()
+
+
+def snapshot():
+    '''Copy of all entries, picklable'''
+    with LOCK: return {k: Stage(st.calls, st.wall, st.cpu, st.bytes, st.records, st.rss, st.rss_growth)
+                       for k, st in STAGES.items()}
+
+
+def merge(snap):
+    '''Adds entries of snapshot() taken elsewhere, e.g. in worker process'''
+    for (name, key), st in snap.items(): add(name, key, st)
+
+
+def collect(worker, *args):
+    '''Pool task wrapper - calls worker with metrics of this call only and
+    returns (result, snapshot()). The pool process may have run other tasks before.'''
+    reset()
+    return worker(*args), snapshot()
+
+
+def enable(profile=False, trace=False):
+    '''Switches cProfile and/or tracemalloc on for the rest of the run'''
+    if profile and RUN['profiler'] is None:
+        RUN['profiler'] = cProfile.Profile()
+        RUN['profiler'].enable()
+    if trace and not tracemalloc.is_tracing(): tracemalloc.start()
+
+
+def rows():
+    '''Entries as list of dicts ordered by stage and key, stage totals (key None) first'''
+    res = []
+    for (name, key), st in sorted(snapshot().items(), key=lambda kv: (kv[0][0], kv[0][1] is not None, str(kv[0][1]))):
+        res.append(dict({'stage': name, 'key': key}, **st.row()))
+    return res
+
+
+def frame():
+    return pd.DataFrame(rows(), columns=COLUMNS)
+
+
+def run_info(**info):
+    t = os.times()
+    res = {'start': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(RUN['start'])),
+           'wall': time.time() - RUN['start'], 'cpu': t.user + t.system,
+           'children_cpu': t.children_user + t.children_system,
+           'peak_rss': peak_rss(), 'argv': sys.argv}
+    res.update(info)
+    return res
+
+
+def report(path, **info):
+    '''Writes metrics of the run into path - CSV rows when it ends with .csv,
+    otherwise JSON with run info (plus info given), stages and tracemalloc top
+    allocations. cProfile statistics are dumped into <path>.prof.'''
+    if path.lower().endswith('.csv'):
+        with open(path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=COLUMNS)
+            writer.writeheader()
+            writer.writerows(rows())
+    else:
+        doc = {'run': run_info(**info), 'stages': rows()}
+        if tracemalloc.is_tracing():
+            doc['run']['traced_peak'] = tracemalloc.get_traced_memory()[1]
+            stats = tracemalloc.take_snapshot().statistics('lineno')[:TRACEMALLOC_TOP]
+            doc['tracemalloc'] = [{'site': str(s.traceback), 'size': s.size, 'count': s.count} for s in stats]
+        with open(path, 'w') as f: json.dump(doc, f, indent=1, default=str)
+    if RUN['profiler'] is not None:
+        RUN['profiler'].disable()
+        RUN['profiler'].dump_stats(path + '.prof')
+        RUN['profiler'].enable()
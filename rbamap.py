@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+RBA over time density maps of x'50' database updates. Instead of scatter plot
+of millions of points every DBD gets 2-D histogram (time bucket x RBA bucket)
+per call type of log50CallFlag. Only datetime, RBA and call type of every
+update are kept, sorted by DBD and time, so a map of any time and RBA range
+(zoom) is binned from the selected points only. Computed maps are cached.
+Raw points stay in memory, not a pre-binned grid - about 14 bytes per update
+(DBD category code, datetime64, uint32 RBA, call type), DBD names are kept
+once as categories and never decoded per record.
+
+    rmaps = rbamap.RBAMaps.from_store(LogStore('store/'), start='2018-08-06')
+    m = rmaps.map('BA1P0050')                   # whole range of the DBD
+    m = rmaps.zoom('BA1P0050', '2018-08-06 12:00', '2018-08-06 13:00', 0, 0x100000)
+    m.plot()
+    rmaps.hot_spots()                           # busiest RBA buckets of all DBDs
+'''
+
+import pandas as pd
+import numpy as np
+from pandas.api.types import union_categoricals
+import logspecs
+
+'''Call types of the maps - single flags of log50CallFlag and the rest'''
+CALLS = [f.name for f in logspecs.log50CallFlag] + ['other']
+
+'''Call type index of every value of the call flag byte'''
+CALL_INDEX = np.full(256, len(CALLS) - 1, dtype=np.uint8)
+for i, f in enumerate(logspecs.log50CallFlag): CALL_INDEX[f.value] = i
+
+'''Fields of x'50' record needed for the maps, call byte is taken as number and
+DBD name as 8 byte number too - only distinct names are decoded, no string per record'''
+FIELDS50 = logspecs.compile_fields({'dbd': dict(logspecs.log_items['50']['dbd'], type='int'),
+                                    'rba': logspecs.log_items['50']['rba'],
+                                    'call': {'type': 'int', 'off_start': 0x3b, 'off_end': 0x3c}}, '50')
+
+TIME_BINS = 200
+RBA_BINS = 200
+
+'''Records of one dataframe turned into points at once, bounds extraction temporaries'''
+CHUNK_ROWS = 100000
+
+
+class RBAMap:
+    '''2-D histogram of one DBD - counts[call, time bucket, rba bucket]'''
+    def __init__(self, dbd, counts, time_edges, rba_edges):
+        self.dbd = dbd
+        self.counts = counts            # int64 array len(CALLS) x time bins x rba bins
+        self.time_edges = time_edges    # datetime64[us] bucket edges
+        self.rba_edges = rba_edges      # float64 bucket edges
+
+    def total(self, call=None):
+        '''Counts of all call types or of one ('isrt', 'repl', 'dlet', 'rolx', 'other')'''
+        return self.counts.sum(axis=0) if call is None else self.counts[CALLS.index(call)]
+
+    def frame(self, call=None):
+        '''Counts as dataframe, index time bucket start, columns rba bucket start'''
+        return pd.DataFrame(self.total(call), index=self.time_edges[:-1], columns=self.rba_edges[:-1])
+
+    def plot(self, call=None, ax=None, **kwargs):
+        '''Heat map with time on x axis and RBA on y axis'''
+        import matplotlib.pyplot as plt
+        import matplotlib.dates as mdates
+        if ax is None: ax = plt.figure().gca()
+        t = mdates.date2num(self.time_edges[[0, -1]].astype('datetime64[us]').astype(object))
+        img = ax.imshow(self.total(call).T, origin='lower', aspect='auto', interpolation='nearest',
+                        extent=(t[0], t[1], self.rba_edges[0], self.rba_edges[-1]), **kwargs)
+        ax.xaxis_date()
+        ax.set_title('{} {}'.format(self.dbd, call or 'all calls'))
+        ax.set_ylabel('rba')
+        return img
+
+
+class RBAMaps:
+    '''Points of x'50' updates of all DBDs and their cached density maps.
+    dbd is categorical (or array of names), only its codes are kept per point.'''
+    def __init__(self, dbd, datetime, rba, call):
+        dbd = pd.Categorical(dbd).remove_unused_categories()
+        dbd = dbd.reorder_categories(sorted(dbd.categories))
+        codes = dbd.codes
+        datetime = np.asarray(datetime, dtype='datetime64[us]')
+        order = np.lexsort((datetime, codes))
+        self.code, self.datetime = codes[order], datetime[order]
+        self.rba = np.asarray(rba, dtype=np.uint32)[order]
+        self.call = np.asarray(call, dtype=np.uint8)[order]
+        self.dbds = np.asarray(dbd.categories, dtype=object)
+        bounds = np.searchsorted(self.code, np.arange(len(self.dbds) + 1))
+        self.slices = {d: slice(s, e) for d, s, e in zip(self.dbds.tolist(), bounds[:-1].tolist(), bounds[1:].tolist())}
+        self.cache = {}
+
+    @classmethod
+    def from_frames(cls, frames):
+        '''From iterable of dataframes with x'50' records (blob and datetime columns,
+        records of other types are skipped when type column is present)'''
+        parts = [points(df) for df in frames]
+        if len(parts) == 0: return cls(pd.Categorical([]), np.array([], dtype='datetime64[us]'),
+                                       np.array([], dtype=np.uint32), np.array([], dtype=np.uint8))
+        return cls(union_categoricals([p[0] for p in parts]), *(np.concatenate([p[i] for p in parts]) for i in range(1, 4)))
+
+    @classmethod
+    def from_frame(cls, df, chunk_rows=CHUNK_ROWS):
+        return cls.from_frames(df.iloc[i:i + chunk_rows] for i in range(0, len(df), chunk_rows))
+
+    @classmethod
+    def from_store(cls, store, start=None, end=None, dbds=None):
+        '''From x'50' partitions of LogStore, read batch by batch, blobs are dropped right away'''
+        rmaps = cls.from_frames(store.batches(types='50', start=start, end=end, columns=['blob', 'datetime']))
+        if dbds is not None: rmaps = rmaps.select(dbds)
+        return rmaps
+
+    def select(self, dbds):
+        '''RBAMaps of given DBDs only'''
+        keep = np.isin(self.code, np.flatnonzero(np.isin(self.dbds, list(dbds))))
+        dbd = pd.Categorical.from_codes(self.code[keep], categories=self.dbds)
+        return RBAMaps(dbd, self.datetime[keep], self.rba[keep], self.call[keep])
+
+    def map(self, dbd, start=None, end=None, rba_lo=None, rba_hi=None, time_bins=TIME_BINS, rba_bins=RBA_BINS):
+        '''RBAMap of dbd for time range [start, end) and RBA range [rba_lo, rba_hi),
+        ranges default to the DBD's data. Maps are cached.'''
+        key = (dbd, start, end, rba_lo, rba_hi, time_bins, rba_bins)
+        if key not in self.cache: self.cache[key] = self.bin(*key)
+        return self.cache[key]
+
+    def zoom(self, dbd, start, end, rba_lo=None, rba_hi=None, time_bins=TIME_BINS, rba_bins=RBA_BINS):
+        '''The same as map(), only points of the selected range are binned'''
+        return self.map(dbd, start, end, rba_lo, rba_hi, time_bins, rba_bins)
+
+    def bin(self, dbd, start, end, rba_lo, rba_hi, time_bins, rba_bins):
+        sl = self.slices.get(dbd, slice(0, 0))
+        t, rba, call = self.datetime[sl], self.rba[sl], self.call[sl]
+        # points are sorted by time within the DBD, time range is cut by binary search
+        lo = 0 if start is None else np.searchsorted(t, np.datetime64(pd.Timestamp(start), 'us'), 'left')
+        hi = len(t) if end is None else np.searchsorted(t, np.datetime64(pd.Timestamp(end), 'us'), 'left')
+        t, rba, call = t[lo:hi], rba[lo:hi], call[lo:hi]
+        if rba_lo is not None or rba_hi is not None:
+            keep = (rba >= (rba_lo or 0)) & ((rba < rba_hi) if rba_hi is not None else True)
+            t, rba, call = t[keep], rba[keep], call[keep]
+        tmin = np.datetime64(pd.Timestamp(start), 'us') if start is not None else (t[0] if len(t) else np.datetime64(0, 'us'))
+        tmax = np.datetime64(pd.Timestamp(end), 'us') if end is not None else (t[-1] + np.timedelta64(1, 'us') if len(t) else tmin + np.timedelta64(1, 's'))
+        rmin = float(rba_lo) if rba_lo is not None else 0.0
+        rmax = float(rba_hi) if rba_hi is not None else (float(rba.max()) + 1 if len(rba) else 1.0)
+        ti = bucket_index(t.astype(np.int64), tmin.astype(np.int64), tmax.astype(np.int64), time_bins)
+        ri = bucket_index(rba.astype(np.float64), rmin, rmax, rba_bins)
+        flat = (call.astype(np.int64) * time_bins + ti) * rba_bins + ri
+        counts = np.bincount(flat, minlength=len(CALLS) * time_bins * rba_bins).reshape(len(CALLS), time_bins, rba_bins)
+        time_edges = tmin + ((tmax - tmin) * np.arange(time_bins + 1) / time_bins).astype('timedelta64[us]')
+        return RBAMap(dbd, counts, time_edges, np.linspace(rmin, rmax, rba_bins + 1))
+
+    def maps(self, start=None, end=None, time_bins=TIME_BINS, rba_bins=RBA_BINS):
+        '''RBAMap of every DBD for common time range'''
+        if start is None and len(self.datetime): start = pd.Timestamp(self.datetime.min())
+        if end is None and len(self.datetime): end = pd.Timestamp(self.datetime.max()) + pd.Timedelta(1, 'us')
+        return {d: self.map(d, start, end, time_bins=time_bins, rba_bins=rba_bins) for d in self.dbds.tolist()}
+
+    def hot_spots(self, n=20, start=None, end=None, rba_bins=RBA_BINS):
+        '''Busiest RBA buckets over all DBDs - dbd, rba range, counts per call type'''
+        rows = []
+        for d, m in self.maps(start, end, time_bins=1, rba_bins=rba_bins).items():
+            per_call = m.counts[:, 0, :]
+            for i in np.argsort(per_call.sum(axis=0))[::-1][:n]:
+                rows.append(dict({'dbd': d, 'rba_from': int(m.rba_edges[i]), 'rba_to': int(m.rba_edges[i + 1]),
+                                  'count': int(per_call[:, i].sum())}, **dict(zip(CALLS, per_call[:, i].tolist()))))
+        res = pd.DataFrame(rows, columns=['dbd', 'rba_from', 'rba_to', 'count'] + CALLS)
+        return res.sort_values('count', ascending=False, kind='stable').head(n).reset_index(drop=True)
+
+
+def points(df):
+    '''dbd (categorical), datetime, rba and call type index arrays of x'50' records in df'''
+    sel = np.flatnonzero(np.asarray(df['type'] == '50')) if 'type' in df else np.arange(len(df))
+    cols = FIELDS50.extract(df['blob'].iloc[sel].tolist())
+    codes, names = pd.factorize(cols['dbd'])
+    names = [int(n).to_bytes(8, 'big').decode('cp500').rstrip() for n in names]
+    stripped, names = pd.factorize(pd.Index(names, dtype=object))
+    t = np.asarray(df['datetime'], dtype='datetime64[us]')[sel]
+    valid = ~np.isnat(t)                  # updates without clock can't be placed in time
+    dbd = pd.Categorical.from_codes(stripped[codes][valid], categories=names)
+    return (dbd, t[valid], np.asarray(cols['rba'], dtype=np.uint32)[valid],
+            CALL_INDEX[np.asarray(cols['call'], dtype=np.int64)][valid])
+
+
+def bucket_index(values, lo, hi, bins):
+    '''Bucket of every value in [lo, hi) split into bins equal buckets'''
+    idx = ((values - lo) * bins // max(hi - lo, 1)).astype(np.int64) if len(values) else np.zeros(0, dtype=np.int64)
+    return np.clip(idx, 0, bins - 1)